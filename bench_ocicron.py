@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import tracemalloc
+import statistics
+import subprocess
+
+
+DEFAULT_RUNS=1
+DEFAULT_TIMEOUT=1800
+TREE=os.path.dirname(os.path.abspath(__file__))
+
+#Synthetic tenancy sizes, FakeTenancy arguments
+SIZES={
+    'small': {'regions': 2, 'compartments': 20, 'instances': 100, 'db_systems': 2, 'tagged': 0.3, 'slots': 4},
+    'large': {'regions': 4, 'compartments': 200, 'instances': 500, 'db_systems': 5, 'tagged': 0.3, 'slots': 4},
+}
+
+#name -> (scenarios run before it in the same working directory and not reported, tenancy overrides)
+SCENARIOS={
+    'discovery': ([], {}),
+    'sync': ([], {}),
+    'sync-unchanged': (['sync'], {}),
+    'slot-start': (['sync'], {'initial_state': 'STOPPED'}),
+    'slot-stop': (['sync'], {'initial_state': 'RUNNING'}),
+}
+
+def run_scenario(name):
+    """
+    Run one scenario in this process against ocicron.CLIENTS
+    """
+    import ocicron
+    if name == 'discovery':
+        conn = ocicron.connect()
+        conn.get_suscribed_regions()
+        ocicron.db.set_compartments(ocicron.discover_compartments(conn, [], refresh=True))
+        ocicron.generate_entries(conn.suscribed_regions)
+    elif name in ('sync', 'sync-unchanged'):
+        ocicron.sync()
+    elif name == 'slot-start':
+        ocicron.run_slot(ocicron.CLIENTS.regions[0], 'start', '08', 'no')
+    elif name == 'slot-stop':
+        ocicron.run_slot(ocicron.CLIENTS.regions[0], 'stop', '20', 'no')
+
+def child(name, tenancy, rate_limit, discovery):
+    """
+    Run a scenario in a child process started in its working directory and print its measures as JSON
+    """
+    sys.path.insert(0, TREE)
+    import ocicron_service
+    if rate_limit:
+        #pace calls far above the service limits, the stand-in answers 429s when asked to
+        ocicron_service.RATE_LIMITS = {service: (rate_limit, rate_limit) for service in ocicron_service.RATE_LIMITS}
+        ocicron_service.DEFAULT_RATE_LIMIT = (rate_limit, rate_limit)
+    ocicron_service.DISCOVERY_BACKEND = discovery
+    import ocicron
+    from ocicron_fake import FakeTenancy
+
+    ocicron_service.setup_logging(os.path.join(os.getcwd(), 'ocicron.log'))
+    tabfile = os.path.join(os.getcwd(), 'crontab')
+    open(tabfile, 'a').close()
+    ocicron.cron = ocicron_service.Schedule(tabfile=tabfile)
+    ocicron.CLIENTS = FakeTenancy(**tenancy)
+
+    #the SDK modules are loaded on first use, load them first so neither the wall time nor the heap counts them
+    import oci.core, oci.database, oci.identity, oci.resource_search
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Python heap of the scenario alone, RSS also counts the interpreter and the imported modules
+    tracemalloc.start()
+    start = time.monotonic()
+    run_scenario(name)
+    elapsed = time.monotonic() - start
+    _, peak_heap = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(json.dumps({
+        'wall': elapsed,
+        'calls': ocicron.CLIENTS.calls,
+        'throttled': ocicron.CLIENTS.throttled,
+        'limiter_wait': ocicron_service.metrics.summary()['totals']['limiter_wait'],
+        #kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'startup_rss_mb': before / 1024,
+        'peak_heap_mb': peak_heap / 1024 / 1024,
+    }))
+
+def run_once(name, workdir, tenancy, rate_limit, discovery, timeout):
+    """
+    Return the measures of one scenario run in a child process, None when it timed out or failed
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--child', name,
+        '--tenancy', json.dumps(tenancy), '--rate-limit', str(rate_limit), '--discovery', discovery]
+    try:
+        result = subprocess.run(command, cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return None
+    if result.returncode != 0:
+        return None
+    return json.loads(result.stdout.decode().strip().splitlines()[-1])
+
+def bench(names, tenancy, runs, rate_limit, discovery, timeout):
+    """
+    Run every scenario from an empty working directory, after its unreported setup scenarios
+    return a dictionary of scenario -> list of measures
+    """
+    results = {}
+    for name in names:
+        setup, overrides = SCENARIOS[name]
+        scenario_tenancy = dict(tenancy, **overrides)
+        results[name] = []
+        for _ in range(runs):
+            workdir = tempfile.mkdtemp(prefix='ocicron-bench-')
+            try:
+                for step in setup:
+                    run_once(step, workdir, scenario_tenancy, rate_limit, discovery, timeout)
+                measures = run_once(name, workdir, scenario_tenancy, rate_limit, discovery, timeout)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            results[name].append(measures)
+            if measures is None:
+                break
+    return results
+
+def summary(measures):
+    if any(m is None for m in measures):
+        return 'failed or timeout'
+    walls = [m['wall'] for m in measures]
+    last = measures[-1]
+    return 'wall min {:.2f}s median {:.2f}s  api calls {:>7}  429s {:>4}  limiter wait {:.1f}s  peak rss {:.1f} MB  peak heap {:.1f} MB'.format(
+        min(walls), statistics.median(walls), sum(last['calls'].values()), last['throttled'], last['limiter_wait'], last['peak_rss_mb'], last['peak_heap_mb'])
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python bench_ocicron.py',
+        description='Measure discovery, sync and slot runs against a synthetic tenancy served by ocicron_fake.py')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run, all by default: {}'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--size', choices=list(SIZES), default='small')
+    parser.add_argument('--regions', type=int)
+    parser.add_argument('--compartments', type=int)
+    parser.add_argument('--instances', type=int, help='instances per compartment and region')
+    parser.add_argument('--tagged', type=float, help='fraction of resources with schedule tags')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API call')
+    parser.add_argument('--throttle', type=float, default=0.0, help='probability of a 429 answer to an API call')
+    parser.add_argument('--rate-limit', type=float, default=1000,
+        help='calls per second of every limiter, 0 keeps RATE_LIMITS of ocicron_service.py')
+    parser.add_argument('--discovery', choices=['crawl', 'search'], default='crawl', help='DISCOVERY_BACKEND of the runs')
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS)
+    parser.add_argument('--timeout', type=int, default=DEFAULT_TIMEOUT, help='seconds before a run is reported as timeout')
+    parser.add_argument('--calls', action='store_true', help='print the API calls of every operation')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--tenancy', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, json.loads(args.tenancy), args.rate_limit, args.discovery)
+        return
+
+    tenancy = dict(SIZES[args.size], page_size=args.page_size, latency=args.latency, throttle=args.throttle)
+    for option in ('regions', 'compartments', 'instances', 'tagged'):
+        if getattr(args, option) is not None:
+            tenancy[option] = getattr(args, option)
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(unknown)))
+    results = bench(names, tenancy, args.runs, args.rate_limit, args.discovery, args.timeout)
+    for name in names:
+        print('{:<16} {}'.format(name, summary(results[name])))
+        if args.calls and results[name][-1] is not None:
+            for operation, count in sorted(results[name][-1]['calls'].items()):
+                print('{:<16}   {:<28} {}'.format('', operation, count))
+
+
+if __name__ == "__main__":
+    main()
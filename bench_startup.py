@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+
+DEFAULT_RUNS=10
+DEFAULT_TIMEOUT=60
+TREE=os.path.dirname(os.path.abspath(__file__))
+
+#name -> ocicron.py arguments, None means a bare import of the module
+SCENARIOS={
+    'import': None,
+    'help': ['help'],
+    'execute-no-match': ['--region', 'us-ashburn-1', '--action', 'start', '--at', '03', '--weekend-stop', 'no'],
+}
+
+def run_once(tree, workdir, args, timeout):
+    """
+    Return the wall time of one ocicron process, None when it timed out
+    """
+    if args is None:
+        command = [sys.executable, '-c', 'import sys; sys.path.insert(0, {!r}); import ocicron'.format(tree)]
+    else:
+        command = [sys.executable, os.path.join(tree, 'ocicron.py')] + args
+    start = time.monotonic()
+    try:
+        subprocess.run(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return None
+    return time.monotonic() - start
+
+def bench(tree, runs, timeout):
+    """
+    Run every scenario against a source tree from an empty working directory
+    return a dictionary of scenario -> list of wall times
+    """
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='ocicron-bench-')
+    try:
+        for name, args in SCENARIOS.items():
+            results[name] = []
+            for _ in range(runs):
+                elapsed = run_once(tree, workdir, args, timeout)
+                results[name].append(elapsed)
+                if elapsed is None:
+                    break
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def checkout(ref):
+    """
+    Check out a git ref in a temporary worktree and return its path
+    """
+    path = tempfile.mkdtemp(prefix='ocicron-ref-')
+    subprocess.run(['git', '-C', TREE, 'worktree', 'add', '--detach', path, ref], check=True, stdout=subprocess.DEVNULL)
+    return path
+
+def summary(times):
+    if any(t is None for t in times):
+        return 'timeout'
+    return 'min {:.3f}s  median {:.3f}s'.format(min(times), statistics.median(times))
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python bench_startup.py',
+        description='Measure ocicron startup time: module import, help and an execute slot matching nothing')
+    parser.add_argument('--ref', help='git ref to compare against, for example the commit before lazy imports')
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS)
+    parser.add_argument('--timeout', type=int, default=DEFAULT_TIMEOUT, help='seconds before a run is reported as timeout')
+    args = parser.parse_args()
+
+    trees = [('current', TREE)]
+    worktree = None
+    if args.ref:
+        worktree = checkout(args.ref)
+        trees.insert(0, (args.ref, worktree))
+
+    try:
+        results = [(label, bench(tree, args.runs, args.timeout)) for label, tree in trees]
+    finally:
+        if worktree is not None:
+            subprocess.run(['git', '-C', TREE, 'worktree', 'remove', '--force', worktree], stdout=subprocess.DEVNULL)
+
+    for name in SCENARIOS:
+        for label, result in results:
+            print('{:<18} {:<12} {}'.format(name, label, summary(result[name])))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,15 @@
 from logging import exception
 import os
 import sys
+import time
+import signal
+import socket
 import argparse
-from ocicron_service import OCI, ScheduleDB, Schedule, logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from ocicron_service import OCI, ScheduleDB, LeaseStore, partition_of, region_partitions, Schedule, SlotWheel, LoadPlanner, slot_minute, ActionEngine, ExecutionJournal, PROVIDERS, TARGET_STATES, entry_tables, completion_report, rate_limit, min_slot_seconds, LazyObject, setup_logging, log_context, logging, metrics
 
 
 DEFAULT_LOCATION=os.getcwd()
@@ -12,217 +19,658 @@ DEFAULT_AUTH_TYPE='principal'
 DEFAULT_PROFILE="DEFAULT"
 DEFAULT_SYNC_SCHEDULE='30 23 * * *'
 DEFAULT_SYNC_COMMAND='cd {} && ./ocicron.py sync'.format(DEFAULT_LOCATION)
+DEFAULT_DAEMON_COMMAND='cd {} && ./ocicron.py daemon'.format(DEFAULT_LOCATION)
+DEFAULT_LEASE_COMMAND='cd {} && ./ocicron.py leases'.format(DEFAULT_LOCATION)
+#'cron' adds one crontab job per slot, 'dispatch' one job per firing minute running every slot of that minute
+#in a single process, 'daemon' fires every slot from a resident ocicron.py daemon process
+SCHEDULER_MODE='cron'
+#Seconds between checks for schedule changes while the daemon waits for the next minute
+DAEMON_POLL_SECONDS=15
+#Slots the daemon runs at the same time
+DAEMON_SLOT_WORKERS=4
+#Missed minutes the daemon still fires after a pause, older slots are skipped like cron does
+DAEMON_MAX_CATCHUP_MINUTES=5
+#Compartment discovery mode: 'subtree' lists the whole tree in one call and caches it, 'crawl' walks it level by level
+COMPARTMENT_DISCOVERY='subtree'
+#Seconds the cached compartment tree is reused before listing it again
+COMPARTMENT_TREE_TTL=7*24*3600
+#Deadline in seconds of --wait when none is given
+DEFAULT_WAIT_DEADLINE=1800
+#Resource providers discovered and scheduled, see PROVIDERS in ocicron_service.py
+#add 'instance_pool' and 'autonomous_database' once the dynamic group has their policy statements,
+#a provider the policies don't allow makes discovery fail and sync stop without writing anything
+RESOURCE_PROVIDERS=['compute', 'database']
+#Regions scanned at the same time, each one uses DISCOVERY_WORKERS threads for its compartments
+REGION_WORKERS=4
+#Stand-in API clients used instead of the OCI SDK ones, for example a FakeTenancy from ocicron_fake.py
+CLIENTS=None
+#SQLite file of the partition leases shared by every controller host running ocicron, on a shared mount,
+#None runs every partition on this host
+LEASE_DB=None
+#Seconds a partition lease lasts unless its controller renews it
+LEASE_SECONDS=900
+#Compartment buckets of a region, each one a partition leased by a single controller
+PARTITIONS_PER_REGION=1
+#Name of this controller in the lease table
+CONTROLLER_ID=os.environ.get('OCICRON_CONTROLLER_ID', socket.gethostname())
+#Schedule of the crontab job renewing the leases between slots, well within LEASE_SECONDS
+LEASE_RENEW_SCHEDULE='*/5 * * * *'
+#Minutes after their tagged time over which the actions of crowded slots are spread in waves
+#to stay under the API rate limit, 0 fires every slot at its tagged time
+SMOOTHING_WINDOW_MINUTES=0
+#Fraction of the RATE_LIMITS requests per second the planner fills in each minute
+SMOOTHING_RATE_FRACTION=0.8
+#Commands whose runs write their metrics, see METRICS_DIR in ocicron_service.py
+METRICS_COMMANDS=('init', 'sync', 'plan', 'dispatch', 'daemon', 'execute')
+#cProfile of a run written with --profile, read it with python -m pstats
+PROFILE_FILE='ocicron_{}.pstats'
+
+#Crontab, read on first use
+cron = LazyObject(Schedule)
+
+#ocicron Database, opened on first use
+db = LazyObject(ScheduleDB)
+
+#Partition leases of the controllers, opened on first use when LEASE_DB is set
+leases = LazyObject(lambda: LeaseStore(LEASE_DB, CONTROLLER_ID, LEASE_SECONDS))
+
+def connect(region=None):
+    """
+    Open a connection to OCI in a region, the home region when None
+    """
+    return OCI(auth_type=DEFAULT_AUTH_TYPE, profile=DEFAULT_PROFILE, region=region, clients=CLIENTS)
 
-#Crontab
-cron = Schedule()
-
-#ocicron Database
-db = ScheduleDB()
+def service_commands():
+    """
+    Return a dictionary of command -> schedule with the daemon and lease renewal jobs the crontab should have,
+    the daemon started with the host in daemon mode, the lease renewal between slots otherwise
+    """
+    if SCHEDULER_MODE == 'daemon':
+        return {DEFAULT_DAEMON_COMMAND: '@reboot'}
+    if LEASE_DB is not None:
+        return {DEFAULT_LEASE_COMMAND: LEASE_RENEW_SCHEDULE}
+    return {}
 
-def schedule_commands():
+def slot_commands():
+    """
+    Return a dictionary of command -> schedule with the slot jobs the crontab should have,
+    none in daemon mode as the daemon fires the slots itself
+    """
+    commands = {}
+    if SCHEDULER_MODE == 'daemon':
+        return commands
+    waves = db.slot_waves()
+    if SCHEDULER_MODE == 'dispatch':
+        for minute in SlotWheel(waves).buckets:
+            schedule, command = cron.dispatch_generator(minute)
+            commands[command] = schedule
+        return commands
+    for (region, action, hour, weekend_stop), offsets in waves.items():
+        try:
+            #a slot split by the load planner gets one job per wave
+            for offset in ([None] if offsets == [0] else offsets):
+                schedule, command = cron.cron_generator(hour, weekend_stop, region, action, offset)
+                commands[command] = schedule
+        except ValueError:
+            logging.warning("Invalid hour {} for {} action in region {}".format(hour, action, region))
+    return commands
+
+def sync_commands():
+    """
+    Bring the slot jobs of the crontab in line with the database, and the daemon and lease renewal
+    jobs in line with SCHEDULER_MODE and LEASE_DB, only jobs that changed are added or removed
     """
-    this function will read database and will schedule command execution
+    desired = slot_commands()
+    desired.update(service_commands())
+    #the command carries region, action, hour and weekend flag so it identifies the job
+    current = cron.jobs('ocicron.py --region')
+    for command in ('ocicron.py dispatch', 'ocicron.py daemon', 'ocicron.py leases'):
+        current.update(cron.jobs(command))
+    removed = [command for command in current if command not in desired]
+    added = [command for command in desired if command not in current]
+    with cron.batch():
+        for command in removed:
+            cron.remove(command)
+        for command in added:
+            cron.new(command, desired[command])
+    if DEFAULT_DAEMON_COMMAND in added:
+        logging.info("Daemon scheduled at boot, start it now with: ./ocicron.py daemon")
+    return {'added': len(added), 'removed': len(removed)}
+
+def owned_partitions(rebalance=False):
     """
-    #Get all entries in the vm table and the db table
-    result = db.vm_table.all()
-    result.extend(db.dbsys_table.all())
+    Claim the partitions of every scheduled region, renewing the leases of this controller,
+    with rebalance it keeps only its share and releases the rest, see LeaseStore
+    return the partitions it owns, None when leases are off and every partition runs here
+    """
+    if LEASE_DB is None:
+        return None
+    return set(leases.claim([p for region in db.regions() for p in region_partitions(region, PARTITIONS_PER_REGION)], rebalance=rebalance))
 
-    for r in result:
-            schedule, command = cron.cron_generator(r['Stop'], r['Weekend_stop'].lower(), r['region'], 'stop')
-            if not cron.is_schedule(command):
-                cron.new(command, schedule)
-            schedule, command = cron.cron_generator(r['Start'], r['Weekend_stop'].lower(), r['region'], 'start') 
-            if not cron.is_schedule(command):
-                cron.new(command, schedule)
+def plan_load(window=None, apply=True):
+    """
+    Build the per-minute histogram of the API calls predicted for the schedule and spread the crowded
+    slots over the smoothing window, the planned wave of every resource is stored when apply is set.
+    return the planner
+    """
+    planner = LoadPlanner(SMOOTHING_WINDOW_MINUTES if window is None else window, SMOOTHING_RATE_FRACTION)
+    planner.plan(db.slot_resources())
+    if apply:
+        db.set_offsets(planner.changes())
+    for key in sorted(planner.after):
+        before, after = planner.peak(planner.before[key]), planner.peak(planner.after[key])
+        logging.info("Load plan -- {} {}: peak {} calls/min at {:02d}:{:02d}, planned {} at {:02d}:{:02d}, budget {:.0f}".format(
+            key[0], key[1], before[0], *divmod(before[1], 60), after[0], *divmod(after[1], 60), planner.budget(*key)))
+    for region, service, minute, calls in planner.over_budget():
+        logging.warning("Load plan -- {} {} needs {} calls at {:02d}:{:02d}, above its budget of {:.0f}, raise SMOOTHING_WINDOW_MINUTES or the deadlines".format(
+            region, service, calls, minute // 60, minute % 60, planner.budget(region, service)))
+    return planner
+
+def show_plan(window=None):
+    """
+    Print the load plan of the stored schedule without scheduling anything
+    """
+    for line in plan_load(window, apply=False).report():
+        print(line)
 
-def generate_entries(regions):
+def discover_compartments(oci, comparments_ids, refresh=False):
+    """
+    Set the compartments to scan on the oci connection, from the cached tree when possible
+    """
+    if COMPARTMENT_DISCOVERY == 'crawl':
+        if len(comparments_ids) <= 0:
+            oci.compartment_crawler()
+        else:
+            #crawl compartments
+            for cid in comparments_ids:
+                oci.compartment_crawler(cid)
+        return oci.compartment_ids
+
+    tree = None if refresh else db.load_compartment_tree(COMPARTMENT_TREE_TTL)
+    if tree is None:
+        tree = oci.get_compartment_tree()
+        db.save_compartment_tree(tree)
+        logging.info("Compartment tree fetched -- compartments: {}".format(len(tree)))
+    else:
+        logging.info("Using cached compartment tree -- compartments: {}".format(len(tree)))
+    return oci.use_compartment_tree(tree, comparments_ids)
 
+def scan_region(region, compartment_ids):
+    """
+    Discover the tagged resources of every provider in a single region
+    return a dictionary of entries key -> entries
+    """
+    start = time.monotonic()
+    conn = connect(region)
+    #No need to search compartments again
+    conn.compartment_ids = compartment_ids
+    #Providers are discovered in parallel
+    found = conn.discover(RESOURCE_PROVIDERS)
+
+    #Generate entry and collect them
     entries = {}
-    vm_entries = []
-    dbs_entries = []
-    for region in regions:
-        try:
-            conn = OCI(auth_type=DEFAULT_AUTH_TYPE, profile=DEFAULT_PROFILE, region=region)
-        except Exception as e:
-            logging.error(e, exc_info=True)
-            sys.exit()
-        #No need to search compartments again
-        conn.compartment_ids = db.cid_table.all()[0]['compartments']
-        #get all instances
-        try:
-            #Get all VMs
-            conn.get_all_instances()
-            #Get all DB systems
-            conn.get_all_dbsystems()
-        except Exception as e:
-            logging.error("Exception occurred", exc_info=True)
-            sys.exit()
-        #filtered VMs
-        filter_vms = conn.vms_by_tags()
-        #filtered DBs
-        filter_dbs = conn.dbs_by_tags()
-        #Generate entry and collect them
-        for vms in filter_vms:
-            entry = {
-                'region':region,
-                'Start':vms['tags']['Start'],
-                'Stop':vms['tags']['Stop'],
-                'Weekend_stop':vms['tags']['Weekend_stop'],
-                'vmOCID':vms['vmOCID']
-            }
-            vm_entries.append(entry)
-        
-        for dbs in filter_dbs:
+    counts = []
+    for name, groups in found.items():
+        provider = PROVIDERS[name]
+        provider_entries = []
+        for group in groups:
             entry = {
                 'region':region,
-                'Start':dbs['tags']['Start'],
-                'Stop':dbs['tags']['Stop'],
-                'Weekend_stop':dbs['tags']['Weekend_stop'],
-                'dbnodeOCID':dbs['dbnodeOCID']
+                'Start':group['tags']['Start'],
+                'Stop':group['tags']['Stop'],
+                'Weekend_stop':group['tags']['Weekend_stop'],
+                provider.ocid_key:group[provider.ocid_key],
+                'details':group['details']
             }
-            dbs_entries.append(entry)
-        
-        entries['vms'] = vm_entries
-        entries['db_nodes'] = dbs_entries        
+            provider_entries.append(entry)
+        entries[provider.entries_key] = provider_entries
+        counts.append('{}: {}'.format(name, sum(len(group[provider.ocid_key]) for group in groups)))
+
+    logging.info("Region {} scanned in {:.1f}s -- compartments: {}, {}".format(
+        region, time.monotonic() - start, len(compartment_ids), ', '.join(counts)))
+    return entries
+
+def generate_entries(regions):
+
+    entries = {key: [] for key in entry_tables()}
+    if len(regions) <= 0:
+        return entries
+    compartment_ids = db.get_compartments()
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=min(REGION_WORKERS, len(regions))) as pool:
+        futures = [pool.submit(scan_region, region, compartment_ids) for region in regions]
+        #Merge results in region order
+        for region, future in zip(regions, futures):
+            try:
+                region_entries = future.result()
+            except Exception as e:
+                logging.error("Exception occurred scanning region {}".format(region), exc_info=True)
+                sys.exit()
+            for key, found in region_entries.items():
+                entries[key].extend(found)
+
+    logging.info("Discovery of {} regions finished in {:.1f}s".format(len(regions), time.monotonic() - start))
     return entries
 
 #init function
-def init(comparments_ids=COMPARTMENTS):
+def init(comparments_ids=COMPARTMENTS, refresh=False):
 
 
     logging.info("===================== Init Start ==========================")
-    if len(db.vm_table.all()) > 0 or len(db.cid_table.all()) > 0:
+    if not db.is_empty():
         logging.info('Database already exists')
         sys.exit()
     
-    oci = OCI(auth_type=DEFAULT_AUTH_TYPE, profile=DEFAULT_PROFILE)
+    oci = connect()
 
-    #get account suscribe regions
-    oci.get_suscribed_regions()
+    with metrics.phase('compartments'):
+        #get account suscribe regions
+        oci.get_suscribed_regions()
 
-    if len(COMPARTMENTS) <= 0:
-        oci.compartment_crawler()
-    else:
-        #crawl compartments
-        for cid in comparments_ids:
-            oci.compartment_crawler(cid)
+        discover_compartments(oci, comparments_ids, refresh)
 
     #Insert compartments in database
-    db.cid_table.insert({'compartments': oci.compartment_ids})
+    db.set_compartments(oci.compartment_ids)
     
     #Scan region and generate entries to the database
-    entries = generate_entries(oci.suscribed_regions)
-    for vm in entries['vms']:
-        db.vm_table.insert(vm)
-    
-    for nodes in entries['db_nodes']:
-        db.dbsys_table.insert(nodes)
+    with metrics.phase('discovery'):
+        entries = generate_entries(oci.suscribed_regions)
+    with metrics.phase('database'):
+        db.insert_entries(entries)
+    with metrics.phase('plan'):
+        plan_load()
     
-    #schedule sync command - check this as well
-    if not cron.is_schedule(DEFAULT_SYNC_COMMAND):
-        cron.new(DEFAULT_SYNC_COMMAND, DEFAULT_SYNC_SCHEDULE)
-
-    #Loop over regions to fund records and create cronjobs
-    schedule_commands()
+    with metrics.phase('cron'), cron.batch():
+        #schedule sync command - check this as well
+        if not cron.is_schedule(DEFAULT_SYNC_COMMAND):
+            cron.new(DEFAULT_SYNC_COMMAND, DEFAULT_SYNC_SCHEDULE)
+
+        #slot jobs, and the daemon or lease renewal job
+        sync_commands()
+    check_deadlines()
     logging.info('Start/Stop commands has been scheduled')
     logging.info("===================== Init End ==========================")
 
-def execute(region, action, hour, weekend_stop, **kwargs):
+def slot_name(region, action, hour, weekend_stop, offset=None):
+    """
+    Label of a slot in logs, journals and metrics, with the offset of its wave when split
+    """
+    name = '{}:{}:{}:{}'.format(region, action, hour, weekend_stop)
+    return name if offset is None else '{}+{}'.format(name, offset)
+
+def run_slot(region, action, hour, weekend_stop, conn=None, engine=None, mode='new', wait=None, offset=None):
+    """
+    Find the resources of a slot in the local database and run the action over them,
+    a connection to the region can be given to reuse its signer and clients.
+    When an engine is given the actions are only queued on it.
+    Every call is recorded in the slot journal, mode 'resume' only runs what the last run
+    didn't get accepted and 'retry' only what it recorded as failed.
+    With wait (seconds) and no engine given, the accepted resources are polled until they reach
+    their target state or the deadline passes, and a completion report is logged.
+    With an offset only the wave the load planner placed that many minutes after the slot is run
+    """
+    with log_context(slot=slot_name(region, action, hour, weekend_stop, offset), region=region):
+        return _run_slot(region, action, hour, weekend_stop, conn, engine, mode, wait, offset)
+
+def _run_slot(region, action, hour, weekend_stop, conn, engine, mode, wait, offset):
+    if action not in ('stop', 'start'):
+        logging.exception("unrecognize action (stop|start)")
+        return
+
+    #provider name -> resources of the slot
+    queries = {name: db.find_resources(PROVIDERS[name].table, region, action, hour, weekend_stop, offset) for name in RESOURCE_PROVIDERS}
+
+    #Nothing to do, don't import the SDK nor create a signer
+    if not any(queries.values()):
+        logging.warning('No resources found for this given query -- region:{}, action:{}, hour:{}, weekend_stop:{}'.format(region, action, hour, weekend_stop))
+        return
+
+    slot = slot_name(region, action, hour, weekend_stop, offset)
+
+    #Act only on the partitions this controller holds a lease on
+    owned = owned_partitions()
+    if owned is not None:
+        partitions = sorted(p for p in owned if p.startswith(region + '/'))
+        total = sum(len(query) for query in queries.values())
+        queries = {name: [r for r in query if partition_of(region, r['compartment_id'], PARTITIONS_PER_REGION) in owned]
+            for name, query in queries.items()}
+        logging.info("Slot {} -- controller: {}, partitions owned: {}, resources of other controllers: {}".format(
+            slot, CONTROLLER_ID, ', '.join(partitions) or 'none', total - sum(len(query) for query in queries.values())))
+        if not any(queries.values()):
+            return
+
+    journal = ExecutionJournal.for_slot(slot, mode)
+    if journal is None:
+        if mode == 'retry':
+            logging.warning('No journal found to retry slot: {}'.format(slot))
+            return
+        journal = ExecutionJournal.for_slot(slot)
+    queries = {name: journal.remaining(query, mode) for name, query in queries.items()}
+    if not any(queries.values()):
+        logging.info('Nothing left to {} in slot: {}, journal: {}'.format(mode, slot, journal.path))
+        journal.close()
+        return
+    logging.info('Slot {} journal: {}'.format(slot, journal.path))
+
+    #connect to OCI
+    if conn is None:
+        try:
+            conn = connect(region)
+        except Exception as e:
+            logging.error(e, exc_info=True)
+            journal.close()
+            return
+
+    #(table, states found, skipped OCIDs, pending OCIDs, target state) of each provider of the slot
+    planned = []
+
+    def save_states(journal):
+        for table, found, skipped, pending, target in planned:
+            db.update_states(table, settled_states(found, skipped, pending, target, journal.outcomes))
+
+    run = engine is None
+    if run:
+        engine = ActionEngine()
+    #the states are stored once the actions have run, the engine of a dispatch runs them later
+    engine.attach(journal, save_states)
+    #(resources, action, provider name) of the actions queued, polled in wait mode
+    targets = []
+
+    with metrics.phase('plan'):
+        for name, query in queries.items():
+            if len(query) <= 0:
+                continue
+            provider = PROVIDERS[name]
+            provider_action = provider.actions[action]
+            logging.info("Executing {} action on {} resources, in region: {} at: {} and Weekend_stop: {} on {} OCIDs".format(
+                provider_action, name, region, hour, weekend_stop, len(query)))
+
+            #Skip resources already in the target state
+            pending, skipped, states = conn.pending_actions(query, provider_action, service=name)
+            engine.skip(len(skipped))
+            planned.append((provider.table, states, skipped, pending, TARGET_STATES[name][provider_action]))
+
+            #Queue the provider action on the remaining OCIDs
+            if len(pending) > 0:
+                conn.resource_action(name, pending, provider_action, engine=engine, journal=journal, priorities=priorities(query))
+                targets.append((pending_resources(query, pending), provider_action, name))
+
+    #Size the worker pool for the tightest deadline of the slot resources
+    deadlines = [r['deadline'] for query in queries.values() for r in query if r['deadline'] is not None]
+    counts = {name: len(resources) for resources, _, name in targets}
+    if len(deadlines) > 0 and len(counts) > 0:
+        #a wave starts offset minutes into the deadline of its slot
+        minutes = max(1, min(deadlines) - (offset or 0))
+        deadline = minutes * 60
+        services = {PROVIDERS[name].service for name in counts}
+        engine.size_for_deadline(sum(counts.values()), deadline, sum(rate_limit(region, service)[0] for service in services))
+        if min_slot_seconds(counts, region) > deadline:
+            logging.warning("Slot {} can't issue {} actions within its {} minutes deadline under the API rate limit".format(
+                slot, sum(counts.values()), minutes))
+
+    #Run every queued action of the slot on the worker pool, by priority
+    if run:
+        started = time.monotonic()
+        with metrics.phase('actions'):
+            report = engine.run(slot)
+        if wait:
+            #only the resources whose action was accepted are expected to change state
+            accepted = [([r for r in resources if journal.outcomes.get(r['ocid']) == 'accepted'], target_action, service)
+                for resources, target_action, service in targets]
+            with metrics.phase('wait'):
+                reached, stragglers = conn.wait_for_states(accepted, wait, started)
+            report['completion'] = completion_report(slot, reached, stragglers, wait)
+        return report
+
+def priorities(resources):
+    """
+    Return a dictionary of OCID -> priority of the slot resources with one stored
+    """
+    return {r['ocid']: r['priority'] for r in resources if r['priority'] is not None}
+
+def check_deadlines():
+    """
+    Warn about slots whose deadline can't be met under the API rate limit,
+    slots of a region firing at the same hour share the rate limit
+    """
+    loads = db.slot_loads()
+    providers = {provider.table: name for name, provider in PROVIDERS.items()}
+    #(region, hour) -> {provider name: actions}
+    demand = {}
+    for table, region, action, hour, weekend_stop, count, deadline in loads:
+        counts = demand.setdefault((region, hour), {})
+        counts[providers[table]] = counts.get(providers[table], 0) + count
+    late = 0
+    slots = {}
+    for table, region, action, hour, weekend_stop, count, deadline in loads:
+        if deadline is not None:
+            key = (region, action, hour, weekend_stop)
+            slots[key] = min(deadline, slots.get(key, deadline))
+    for (region, action, hour, weekend_stop), deadline in sorted(slots.items()):
+        needed = min_slot_seconds(demand[(region, hour)], region)
+        if needed > deadline * 60:
+            late += 1
+            logging.warning("Slot {}:{}:{}:{} can't meet its {} minutes deadline, the API rate limit needs {:.0f} minutes for the actions firing at {} in {}".format(
+                region, action, hour, weekend_stop.lower(), deadline, needed / 60, hour, region))
+    return late
+
+def settled_states(found, skipped, pending, target, outcomes):
+    """
+    Return a dictionary of OCID -> lifecycle state the resources of a slot settle in,
+    the target state for the ones skipped or whose action the journal recorded as accepted,
+    the state found before the actions for the others
+    """
+    states = dict(found)
+    for ocid in skipped:
+        states[ocid] = target
+    for ocid in pending:
+        if outcomes.get(ocid) == 'accepted':
+            states[ocid] = target
+    return states
+
+def pending_resources(resources, pending):
+    """
+    Keep the resources of a slot whose OCID is in the pending list
+    """
+    pending = set(pending)
+    return [r for r in resources if r['ocid'] in pending]
+
+def execute(region, action, hour, weekend_stop, mode='new', wait=None, offset=None, **kwargs):
     """
     This function will read argmuments and will find in local database to execute according
 
     0 20 * * * python ocicron.py --region us-ashburn-1 --action stop --at 09 --weekend-stop yes
     """
     logging.info("===================== Execution Start ==========================")
-    
-    if action == 'stop':
-        vm_query = db.vm_table.search((db.query.region == region) & (db.query.Weekend_stop == weekend_stop.capitalize()) & (db.query.Stop == hour))
-        dbs_query = db.dbsys_table.search((db.query.region == region) & (db.query.Weekend_stop == weekend_stop.capitalize()) & (db.query.Stop == hour))  
-    elif action == 'start':
-        vm_query = db.vm_table.search((db.query.region == region) & (db.query.Weekend_stop == weekend_stop.capitalize()) & (db.query.Start == hour))
-        dbs_query = db.dbsys_table.search((db.query.region == region) & (db.query.Weekend_stop == weekend_stop.capitalize()) & (db.query.Start == hour))
-    else:
-        logging.exception("unrecognize action (stop|start)")
+    metrics.labels['slot'] = slot_name(region, action, hour, weekend_stop, offset)
+    run_slot(region, action, hour, weekend_stop, mode=mode, wait=wait, offset=offset)
+    logging.info("===================== Execution END ==========================")
 
-    #connect to OCI
-    try:
-        conn = OCI(auth_type=DEFAULT_AUTH_TYPE, 
-            profile=DEFAULT_PROFILE, 
-            region=region)
-    except Exception as e:
-        logging.error(e, exc_info=True)
-
-    #Compute Service
-    if len(vm_query) <= 0:
-        logging.warning('No VM resources found for this given query -- region:{}, action:{}, hour:{}, weekend_stop:{}'.format(region, action, hour, weekend_stop))
-    else:
-        logging.info("Executing {} action in Compute service, in region: {} at: {} and Weekend_stop: {} on {} instances".format(action, region, hour, weekend_stop, len(vm_query)))
-        if action == 'stop':
-            action = 'softstop'
+def dispatch(hour):
+    """
+    Run every slot of all regions firing at a given hour ('HH' or 'HH:MM') in this process,
+    slots share one worker pool, the rate limiters and a connection per region
 
-        #Execute Instance action on returned instances OCID
-        for grupovm in vm_query:
-            conn.instance_action(grupovm['vmOCID'], action.upper())
-    
-    #Database Service
-    if len(dbs_query) <= 0:
-        logging.warning('No DB system resources found for this given query -- region:{}, action:{}, hour:{}, weekend_stop:{}'.format(region, action, hour, weekend_stop))
+    0 20 * * * python ocicron.py dispatch --at 20
+    """
+    logging.info("===================== Dispatch Start ==========================")
+    slots = SlotWheel(db.slot_waves()).due(datetime.now().replace(hour=slot_minute(hour) // 60, minute=slot_minute(hour) % 60))
+    if len(slots) <= 0:
+        logging.warning("No slots found at: {}".format(hour))
     else:
+        engine = ActionEngine()
+        connections = {}
+        for region, action, slot_hour, weekend_stop, offset in slots:
+            if region not in connections:
+                try:
+                    connections[region] = connect(region)
+                except Exception as e:
+                    logging.error(e, exc_info=True)
+                    continue
+            run_slot(region, action, slot_hour, weekend_stop, conn=connections[region], engine=engine, offset=offset)
+        engine.run('dispatch:{}'.format(hour))
+    logging.info("===================== Dispatch END ==========================")
+
+def daemon():
+    """
+    Resident scheduler, loads the schedule once and fires slots from a timer wheel
+    keeping a warm connection per region. The schedule is reloaded when the database changes.
+    """
+    logging.info("===================== Daemon Start ==========================")
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    connections = {}
+    connections_lock = threading.Lock()
+
+    def connection(region):
+        with connections_lock:
+            if region not in connections:
+                connections[region] = connect(region)
+            return connections[region]
+
+    def fire(slot):
+        region, action, hour, weekend_stop, offset = slot
         try:
-            logging.info("Executing {} action in database service, in region: {} at: {} and Weekend_stop: {}".format(action, region, hour, weekend_stop))
-            for grupodb in dbs_query:
-                conn.database_action(grupodb['dbnodeOCID'], action.upper())
-        except Exception as e:
-            logging.error(e)
-    logging.info("===================== Execution END ==========================")
+            run_slot(region, action, hour, weekend_stop, conn=connection(region), offset=offset)
+        except Exception:
+            logging.error("Exception occurred running slot {}".format(slot_name(*slot)), exc_info=True)
+
+    version = None
+    wheel = None
+    renewed = None
+    last = datetime.now().replace(second=0, microsecond=0)
+    with ThreadPoolExecutor(max_workers=DAEMON_SLOT_WORKERS) as pool:
+        while not stop.is_set():
+            #keep the partition leases between slots
+            if LEASE_DB is not None and (renewed is None or time.monotonic() - renewed > LEASE_SECONDS / 3):
+                try:
+                    owned_partitions(rebalance=True)
+                    renewed = time.monotonic()
+                except Exception:
+                    logging.error("Exception occurred renewing the partition leases", exc_info=True)
+
+            #reload schedules written by sync
+            if db.data_version() != version:
+                version = db.data_version()
+                wheel = SlotWheel(db.slot_waves())
+                logging.info("Daemon schedule loaded -- slots: {}".format(len(wheel)))
+
+            now = datetime.now().replace(second=0, microsecond=0)
+            #do not replay slots missed while the host was suspended
+            if now - last > timedelta(minutes=DAEMON_MAX_CATCHUP_MINUTES):
+                logging.warning("Daemon skipped slots between {} and {}".format(last, now))
+                last = now - timedelta(minutes=1)
+            while last < now:
+                last += timedelta(minutes=1)
+                for slot in wheel.due(last):
+                    pool.submit(fire, slot)
+
+            next_minute = (last + timedelta(minutes=1) - datetime.now()).total_seconds()
+            stop.wait(max(0.5, min(DAEMON_POLL_SECONDS, next_minute)))
+    #hand the partitions over to the other controllers
+    if LEASE_DB is not None:
+        leases.release()
+    logging.info("===================== Daemon End ==========================")
 
 #sync command to update entries
-def sync(comparments_ids=COMPARTMENTS):
+def sync(comparments_ids=COMPARTMENTS, refresh=False):
     """
     This function will crawl compartments and vms tags and update database and crons if needed 
     """
     logging.info("===================== Sync Start ==========================")
 
-    oci = OCI(auth_type=DEFAULT_AUTH_TYPE, profile=DEFAULT_PROFILE)   
-    #get account suscribe regions
-    oci.get_suscribed_regions()
+    oci = connect()
+    with metrics.phase('compartments'):
+        #get account suscribe regions
+        oci.get_suscribed_regions()
 
-    if len(COMPARTMENTS) <= 0:
-        oci.compartment_crawler()
-    else:
-        #crawl compartments
-        for cid in comparments_ids:
-            oci.compartment_crawler(cid)
-    
-    #
+        discover_compartments(oci, comparments_ids, refresh)
+
+    #check if compartments hasn't change
+    if db.get_compartments() != oci.compartment_ids:
+    #Insert compartments in database
+        db.set_compartments(oci.compartment_ids)
+
+    #Scan region and apply only the changes to the database in a single transaction
+    with metrics.phase('discovery'):
+        entries = generate_entries(oci.suscribed_regions)
     try:
-        db.flush()
+        with metrics.phase('database'):
+            changes = db.sync_entries(entries)
     except Exception as err:
         logging.exception(err)
-    
-    #call databse table object
-    db.vm_table
-    db.dbsys_table
+        sys.exit()
 
-    #check if compartments hasn't change
-    if len(db.cid_table.search(db.query.compartments == oci.compartment_ids)) == 0:
-    #Insert compartments in database
-        db.cid_table.update({'compartments': oci.compartment_ids})
+    #spread crowded slots before their jobs are written
+    with metrics.phase('plan'):
+        plan_load()
 
-    #Scan region and generate entries to the database
-    entries = generate_entries(oci.suscribed_regions)
-    for vm in entries['vms']:
-        db.vm_table.insert(vm)
-    
-    for nodes in entries['db_nodes']:
-        db.dbsys_table.insert(nodes)
-    
-    #clean jobs
-    cron.clean_jobs('ocicron.py --region')
-    #query and create cronjobs
-    schedule_commands()
+    #add and remove only the cronjobs that changed
+    with metrics.phase('cron'):
+        changes['cron'] = sync_commands()
+    check_deadlines()
+
+    if not any(count for table in changes.values() for count in table.values()):
+        logging.info("Sync changes -- none")
+    else:
+        for name, counts in changes.items():
+            logging.info("Sync changes -- {}: {}".format(name, ', '.join('{} {}'.format(k, v) for k, v in counts.items())))
     logging.info("===================== Sync End ==========================")
 
+@contextmanager
+def record_run(argv):
+    """
+    Time a command run and write its metrics when it ends, exits included,
+    with --profile a cProfile of the run is written as well
+    """
+    command = argv[0] if len(argv) > 0 and not argv[0].startswith('-') else 'execute'
+    if command not in METRICS_COMMANDS:
+        yield
+        return
+    profiler = None
+    if '--profile' in argv:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    metrics.labels['command'] = command
+    try:
+        with metrics.phase(command):
+            yield
+    finally:
+        name = command
+        if 'slot' in metrics.labels:
+            name = '{}_{}'.format(command, metrics.labels['slot'].replace(':', '_'))
+        if profiler is not None:
+            profiler.disable()
+            path = os.path.join(DEFAULT_LOCATION, PROFILE_FILE.format(name))
+            profiler.dump_stats(path)
+            logging.info("Profile written to {}".format(path))
+        logging.info("Run metrics -- api calls: {calls}, pages: {pages}, retries: {retries}, 429s: {throttled}, rate limiter wait: {limiter_wait:.1f}s".format(
+            **metrics.summary()['totals']))
+        try:
+            path = metrics.write(name)
+            if path is not None:
+                logging.info("Metrics written to {}".format(path))
+        except OSError as err:
+            logging.error("Metrics could not be written: {}".format(err))
+
+def show_leases():
+    """
+    Renew the leases of this controller and print who owns every partition
+
+    */5 * * * * python ocicron.py leases
+    """
+    if LEASE_DB is None:
+        print('Leases are off, set LEASE_DB in ocicron.py to share the partitions between controllers')
+        return
+    owned = owned_partitions(rebalance=True)
+    logging.info("Leases renewed -- controller: {}, partitions: {}".format(CONTROLLER_ID, ', '.join(sorted(owned)) or 'none'))
+    now = time.time()
+    for partition, (owner, expires) in leases.leases().items():
+        print('{:<32} {:<32} {}'.format(partition, owner, 'expires in {:.0f}s'.format(expires - now) if expires > now else 'expired'))
+
 def cli():
     """
 
@@ -242,19 +690,60 @@ def cli():
             ''')
     parser.add_argument('--region', help='oci region to connect', required=True)
     parser.add_argument('--action', help='start or stop', choices=['stop', 'start'], required=True)
-    parser.add_argument('--at', required=True)
+    parser.add_argument('--at', help='hour of the slot, HH or HH:MM', required=True)
     parser.add_argument('--weekend-stop', help='is this machines should remain stopped on weekends', choices=['yes', 'no'], required=True)
+    journal_mode = parser.add_mutually_exclusive_group()
+    journal_mode.add_argument('--resume', dest='mode', action='store_const', const='resume', default='new',
+        help='finish the last run of the slot, resources it got accepted are left out')
+    journal_mode.add_argument('--retry-failed', dest='mode', action='store_const', const='retry',
+        help='run again only the resources the last run of the slot recorded as failed')
+    parser.add_argument('--wait', type=int, nargs='?', const=DEFAULT_WAIT_DEADLINE, metavar='SECONDS',
+        help='wait until the resources reach their target state, at most SECONDS ({} by default), and report the time they took'.format(DEFAULT_WAIT_DEADLINE))
+    parser.add_argument('--offset', type=int, metavar='MINUTES',
+        help='run only the wave the load planner placed MINUTES after the slot, every resource of the slot when omitted')
+    parser.add_argument('--profile', action='store_true', help='write a cProfile of the run to {}'.format(PROFILE_FILE.format('<command>')))
 
     if sys.argv[1] == 'help':
         parser.print_help()
         sys.exit(0)
     
+    #force a new listing of the compartment tree
+    refresh = '--refresh-compartments' in sys.argv[2:]
+
     if sys.argv[1] == 'init':
-        init()
+        init(refresh=refresh)
         sys.exit(0)
 
     if sys.argv[1] == 'sync':
-        sync()
+        sync(refresh=refresh)
+        sys.exit(0)
+
+    if sys.argv[1] == 'dispatch':
+        dispatch_parser = argparse.ArgumentParser(prog='python ocicron.py dispatch')
+        dispatch_parser.add_argument('--at', help='hour of the slots to run, HH or HH:MM', required=True)
+        dispatch_parser.add_argument('--profile', action='store_true')
+        dispatch(dispatch_parser.parse_args(sys.argv[2:]).at)
+        sys.exit(0)
+
+    if sys.argv[1] == 'daemon':
+        daemon()
+        sys.exit(0)
+
+    if sys.argv[1] == 'plan':
+        plan_parser = argparse.ArgumentParser(prog='python ocicron.py plan')
+        plan_parser.add_argument('--window', type=int, metavar='MINUTES',
+            help='smoothing window to preview, SMOOTHING_WINDOW_MINUTES ({}) by default'.format(SMOOTHING_WINDOW_MINUTES))
+        plan_parser.add_argument('--profile', action='store_true')
+        show_plan(plan_parser.parse_args(sys.argv[2:]).window)
+        sys.exit(0)
+
+    if sys.argv[1] == 'leases':
+        show_leases()
+        sys.exit(0)
+
+    #import a scheduleDB.json file from previous versions
+    if sys.argv[1] == 'migrate':
+        db.migrate_json(*sys.argv[2:3])
         sys.exit(0)
 
     return parser.parse_args()
@@ -262,11 +751,14 @@ def cli():
  
 
 if __name__ == "__main__":
-    
-    #argument parser
-    args = cli()
-    #find and execute action over VMs and DB systems
-    execute(args.region, args.action, args.at, args.weekend_stop)
+
+    setup_logging()
+    #write the metrics of the run, and its profile with --profile
+    with record_run(sys.argv[1:]):
+        #argument parser
+        args = cli()
+        #find and execute action over VMs and DB systems
+        execute(args.region, args.action, args.at, args.weekend_stop, mode=args.mode, wait=args.wait, offset=args.offset)
 
 
 
@@ -0,0 +1,358 @@
+import re
+import time
+import random
+import threading
+
+import oci
+
+
+#Fan out of the synthetic compartment tree, the first compartments are children of the tenancy
+COMPARTMENT_FANOUT=8
+#Hours of the synthetic schedules, slot k starts at START_HOURS[k % 6] and stops at STOP_HOURS[k % 6]
+START_HOURS=('08', '07', '09', '06', '10', '05')
+STOP_HOURS=('20', '19', '21', '18', '22', '23')
+#search resource type -> resource type named in search results
+SEARCH_TYPES={
+    'instance': 'Instance',
+    'dbsystem': 'DbSystem',
+    'instancepool': 'InstancePool',
+    'autonomousdatabase': 'AutonomousDatabase',
+}
+
+
+class FakeTenancy:
+    """
+    Local stand-in for the identity, compute, compute management and database services
+    serving a synthetic tenancy, injected with OCI(..., clients=FakeTenancy(...))
+
+    Resources are generated page by page from their index, so the stand-in itself holds
+    almost no memory, only the lifecycle changes made by actions are kept.
+    Every call is counted, can be delayed by latency seconds and answered with a 429
+    with the throttle probability, calls go through the retry strategy of the connection
+    """
+
+    def __init__(self, regions=1, compartments=10, instances=50, db_systems=2, db_nodes=2, instance_pools=1,
+            autonomous_databases=1, tagged=0.5, slots=1, page_size=100, latency=0.0, throttle=0.0,
+            transition_seconds=0.0, initial_state='STOPPED', compartment_node_listing=True, seed=0):
+        """
+        regions, compartments and the number of each resource kind per compartment and region,
+        tagged is the fraction of resources with schedule tags, spread over a number of slots
+        """
+        self.tenancy_id = 'ocid1.tenancy.oc1..fake'
+        self.regions = ['fake-region-{}'.format(i + 1) for i in range(regions)]
+        self.compartments = ['ocid1.compartment.oc1..fake{:06d}'.format(i) for i in range(compartments)]
+        self.counts = {
+            'instance': instances,
+            'dbsystem': db_systems,
+            'instancepool': instance_pools,
+            'autonomousdatabase': autonomous_databases,
+        }
+        self.db_nodes = db_nodes
+        self.tagged = tagged
+        self.slots = slots
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle = throttle
+        self.transition_seconds = transition_seconds
+        self.initial_state = initial_state
+        self.compartment_node_listing = compartment_node_listing
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        #operation -> calls, 429 answers
+        self.calls = {}
+        self.throttled = 0
+        #OCID -> (transition state, target state, time of the action)
+        self.changes = {}
+        #search query -> (kind, compartment, index) of the matching resources
+        self.searches = {}
+
+    def client(self, service, region, retry_strategy=None):
+        """
+        Return the stand-in client of an API service for a region
+        """
+        clients = {
+            'identity': FakeIdentityClient,
+            'compute': FakeComputeClient,
+            'compute_management': FakeComputeManagementClient,
+            'database': FakeDatabaseClient,
+            'search': FakeResourceSearchClient,
+        }
+        return clients[service](self, region or self.regions[0], retry_strategy)
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = {}
+            self.throttled = 0
+
+    def api_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def call(self, operation, retry_strategy, func, *args, **kwargs):
+        """
+        Run one API call through the retry strategy, counting it and injecting latency and 429s
+        """
+        def attempt(*args, **kwargs):
+            with self.lock:
+                self.calls[operation] = self.calls.get(operation, 0) + 1
+                throttled = self.random.random() < self.throttle
+                if throttled:
+                    self.throttled += 1
+            if self.latency > 0:
+                time.sleep(self.latency)
+            if throttled:
+                raise oci.exceptions.ServiceError(429, 'TooManyRequests', {}, 'Too many requests for the tenancy')
+            return func(*args, **kwargs)
+        if retry_strategy is None:
+            return attempt(*args, **kwargs)
+        return retry_strategy.make_retrying_call(attempt, *args, **kwargs)
+
+    def page(self, items, page=None, size=None):
+        """
+        Return one page of a list of item factories as a Response, items are built for this page only
+        """
+        start = int(page or 0)
+        end = start + (size or self.page_size)
+        headers = {'opc-next-page': str(end)} if end < len(items) else {}
+        return oci.response.Response(200, headers, [item() for item in items[start:end]], None)
+
+    def ocid(self, kind, region, compartment, index):
+        return 'ocid1.{}.oc1.{}.fake{:06d}x{:06d}'.format(kind, region, compartment, index)
+
+    def tags(self, compartment, index):
+        """
+        Freeform tags of a resource, schedule tags for the tagged fraction
+        """
+        tags = {'Owner': 'team-{}'.format(index % 7)}
+        if (index * 7919 + compartment * 104729) % 1000 < self.tagged * 1000:
+            slot = index % self.slots
+            tags['Start'] = START_HOURS[slot % 6]
+            tags['Stop'] = STOP_HOURS[slot % 6]
+            tags['Weekend_stop'] = 'Yes' if (slot // 6) % 2 else 'No'
+        return tags
+
+    def state(self, ocid, default):
+        """
+        Current lifecycle state of a resource, actions move it to a transition state
+        and to their target state after transition_seconds
+        """
+        with self.lock:
+            change = self.changes.get(ocid)
+        if change is None:
+            return default
+        transition, target, since = change
+        return target if time.monotonic() - since >= self.transition_seconds else transition
+
+    def default_state(self, kind):
+        """
+        Lifecycle state of a resource no action changed
+        """
+        if kind == 'dbsystem':
+            return 'AVAILABLE'
+        running = self.initial_state == 'RUNNING'
+        if kind in ('instance', 'instancepool'):
+            return 'RUNNING' if running else 'STOPPED'
+        return 'AVAILABLE' if running else 'STOPPED'
+
+    def act(self, ocid, transition, target):
+        with self.lock:
+            self.changes[ocid] = (transition, target, time.monotonic())
+
+    def compartment_index(self, compartment_id):
+        """
+        Index of a synthetic compartment, None for the root compartment which holds no resources
+        """
+        if compartment_id == self.tenancy_id:
+            return None
+        return self.compartments.index(compartment_id)
+
+    def resources(self, kind, region, compartment_id, build):
+        """
+        Item factories of the resources of a kind in a compartment and region
+        """
+        compartment = self.compartment_index(compartment_id)
+        if compartment is None:
+            return []
+        return [lambda i=i: build(self.ocid(kind, region, compartment, i), compartment_id, self.tags(compartment, i), i)
+            for i in range(self.counts[kind])]
+
+
+class FakeClient:
+
+    def __init__(self, tenancy, region, retry_strategy=None):
+        self.tenancy = tenancy
+        self.region = region
+        self.retry_strategy = retry_strategy
+
+    def _call(self, operation, func, *args, **kwargs):
+        return self.tenancy.call(operation, self.retry_strategy, func, *args, **kwargs)
+
+    def _accepted(self, data=None):
+        return oci.response.Response(202, {}, data, None)
+
+
+class FakeIdentityClient(FakeClient):
+
+    def list_region_subscriptions(self, tenancy_id):
+        def regions():
+            return oci.response.Response(200, {}, [
+                oci.identity.models.RegionSubscription(region_name=name, region_key=name.upper(), status='READY', is_home_region=i == 0)
+                for i, name in enumerate(self.tenancy.regions)], None)
+        return self._call('ListRegionSubscriptions', regions)
+
+    def list_compartments(self, compartment_id, compartment_id_in_subtree=False, page=None, **kwargs):
+        def compartments():
+            tenancy = self.tenancy
+            items = []
+            for i, cid in enumerate(tenancy.compartments):
+                parent = tenancy.tenancy_id if i < COMPARTMENT_FANOUT else tenancy.compartments[i // COMPARTMENT_FANOUT - 1]
+                if parent == compartment_id or (compartment_id_in_subtree and compartment_id == tenancy.tenancy_id):
+                    items.append(lambda cid=cid, parent=parent: oci.identity.models.Compartment(
+                        id=cid, compartment_id=parent, name=cid[-10:], lifecycle_state='ACTIVE'))
+            return tenancy.page(items, page)
+        return self._call('ListCompartments', compartments)
+
+
+class FakeComputeClient(FakeClient):
+
+    def list_instances(self, compartment_id, page=None, **kwargs):
+        def instances():
+            tenancy = self.tenancy
+            def build(ocid, cid, tags, i):
+                return oci.core.models.Instance(id=ocid, compartment_id=cid, display_name='vm-{}'.format(i),
+                    lifecycle_state=tenancy.state(ocid, tenancy.initial_state), freeform_tags=tags, defined_tags={},
+                    shape='VM.Standard2.1', region=self.region, availability_domain='AD-1')
+            return tenancy.page(tenancy.resources('instance', self.region, compartment_id, build), page)
+        return self._call('ListInstances', instances)
+
+    def instance_action(self, instance_id, action, **kwargs):
+        def instance_action():
+            if action == 'START':
+                self.tenancy.act(instance_id, 'STARTING', 'RUNNING')
+            else:
+                self.tenancy.act(instance_id, 'STOPPING', 'STOPPED')
+            return self._accepted()
+        return self._call('InstanceAction', instance_action)
+
+
+class FakeComputeManagementClient(FakeClient):
+
+    def list_instance_pools(self, compartment_id, page=None, **kwargs):
+        def instance_pools():
+            tenancy = self.tenancy
+            def build(ocid, cid, tags, i):
+                return oci.core.models.InstancePoolSummary(id=ocid, compartment_id=cid, display_name='pool-{}'.format(i),
+                    lifecycle_state=tenancy.state(ocid, 'RUNNING' if tenancy.initial_state == 'RUNNING' else 'STOPPED'),
+                    freeform_tags=tags, size=10)
+            return tenancy.page(tenancy.resources('instancepool', self.region, compartment_id, build), page)
+        return self._call('ListInstancePools', instance_pools)
+
+    def start_instance_pool(self, instance_pool_id, **kwargs):
+        def start():
+            self.tenancy.act(instance_pool_id, 'STARTING', 'RUNNING')
+            return self._accepted()
+        return self._call('StartInstancePool', start)
+
+    def stop_instance_pool(self, instance_pool_id, **kwargs):
+        def stop():
+            self.tenancy.act(instance_pool_id, 'STOPPING', 'STOPPED')
+            return self._accepted()
+        return self._call('StopInstancePool', stop)
+
+
+class FakeDatabaseClient(FakeClient):
+
+    def _node_state(self):
+        return 'AVAILABLE' if self.tenancy.initial_state == 'RUNNING' else 'STOPPED'
+
+    def list_db_systems(self, compartment_id, page=None, **kwargs):
+        def db_systems():
+            def build(ocid, cid, tags, i):
+                return oci.database.models.DbSystemSummary(id=ocid, compartment_id=cid, display_name='dbsys-{}'.format(i),
+                    lifecycle_state='AVAILABLE', freeform_tags=tags, defined_tags={}, shape='VM.Standard2.2')
+            return self.tenancy.page(self.tenancy.resources('dbsystem', self.region, compartment_id, build), page)
+        return self._call('ListDbSystems', db_systems)
+
+    def list_db_nodes(self, compartment_id, db_system_id=None, page=None, **kwargs):
+        def db_nodes():
+            tenancy = self.tenancy
+            if db_system_id is None and not tenancy.compartment_node_listing:
+                raise oci.exceptions.ServiceError(400, 'MissingParameter', {}, 'dbSystemId is required')
+            compartment = tenancy.compartment_index(compartment_id)
+            items = []
+            for i in range(tenancy.counts['dbsystem'] if compartment is not None else 0):
+                system = tenancy.ocid('dbsystem', self.region, compartment, i)
+                if db_system_id is not None and system != db_system_id:
+                    continue
+                for n in range(tenancy.db_nodes):
+                    ocid = tenancy.ocid('dbnode', self.region, compartment, i * tenancy.db_nodes + n)
+                    items.append(lambda ocid=ocid, system=system: oci.database.models.DbNodeSummary(
+                        id=ocid, db_system_id=system, lifecycle_state=tenancy.state(ocid, self._node_state())))
+            return tenancy.page(items, page)
+        return self._call('ListDbNodes', db_nodes)
+
+    def db_node_action(self, db_node_id, action, **kwargs):
+        def db_node_action():
+            if action == 'START':
+                self.tenancy.act(db_node_id, 'STARTING', 'AVAILABLE')
+            else:
+                self.tenancy.act(db_node_id, 'STOPPING', 'STOPPED')
+            return self._accepted()
+        return self._call('DbNodeAction', db_node_action)
+
+    def list_autonomous_databases(self, compartment_id, page=None, **kwargs):
+        def autonomous_databases():
+            tenancy = self.tenancy
+            def build(ocid, cid, tags, i):
+                return oci.database.models.AutonomousDatabaseSummary(id=ocid, compartment_id=cid, display_name='adb-{}'.format(i),
+                    db_name='adb{}'.format(i), lifecycle_state=tenancy.state(ocid, self._node_state()), freeform_tags=tags)
+            return tenancy.page(tenancy.resources('autonomousdatabase', self.region, compartment_id, build), page)
+        return self._call('ListAutonomousDatabases', autonomous_databases)
+
+    def start_autonomous_database(self, autonomous_database_id, **kwargs):
+        def start():
+            self.tenancy.act(autonomous_database_id, 'STARTING', 'AVAILABLE')
+            return self._accepted()
+        return self._call('StartAutonomousDatabase', start)
+
+    def stop_autonomous_database(self, autonomous_database_id, **kwargs):
+        def stop():
+            self.tenancy.act(autonomous_database_id, 'STOPPING', 'STOPPED')
+            return self._accepted()
+        return self._call('StopAutonomousDatabase', stop)
+
+
+class FakeResourceSearchClient(FakeClient):
+    """
+    Structured queries of the form
+    query instance, dbsystem resources where freeformTags.key = 'Start' && freeformTags.key = 'Stop'
+    """
+
+    def search_resources(self, search_details, limit=None, page=None, **kwargs):
+        def search():
+            tenancy = self.tenancy
+            match = re.match(r"\s*query\s+(.+?)\s+resources(?:\s+where\s+(.*))?$", search_details.query, re.IGNORECASE)
+            if match is None:
+                raise oci.exceptions.ServiceError(400, 'InvalidParameter', {}, 'Unable to parse the query')
+            #tags don't change, the matches of a query are the same on every page and region
+            with tenancy.lock:
+                matches = tenancy.searches.get(search_details.query)
+            if matches is None:
+                kinds = [kind.strip().lower() for kind in match.group(1).split(',')]
+                keys = re.findall(r"freeformTags\.key\s*=\s*'([^']*)'", match.group(2) or '')
+                matches = [(kind, compartment, i) for compartment in range(len(tenancy.compartments)) for kind in kinds
+                    for i in range(tenancy.counts.get(kind, 0)) if all(key in tenancy.tags(compartment, i) for key in keys)]
+                with tenancy.lock:
+                    tenancy.searches[search_details.query] = matches
+            items = [lambda kind=kind, compartment=compartment, i=i: self._summary(kind, compartment, i) for kind, compartment, i in matches]
+            response = tenancy.page(items, page, limit)
+            response.data = oci.resource_search.models.ResourceSummaryCollection(items=response.data)
+            return response
+        return self._call('SearchResources', search)
+
+    def _summary(self, kind, compartment, index):
+        tenancy = self.tenancy
+        ocid = tenancy.ocid(kind, self.region, compartment, index)
+        return oci.resource_search.models.ResourceSummary(resource_type=SEARCH_TYPES[kind], identifier=ocid,
+            compartment_id=tenancy.compartments[compartment], display_name='{}-{}'.format(kind, index),
+            lifecycle_state=tenancy.state(ocid, tenancy.default_state(kind)), freeform_tags=tenancy.tags(compartment, index), defined_tags={})
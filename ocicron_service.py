@@ -1,91 +1,1221 @@
 import os
-import oci
+import copy
+import json
+import atexit
+import base64
+import fcntl
 import logging
+import logging.handlers
+import functools
 import time
-from tinydb import TinyDB, Query
-from crontab import CronTab
+import glob
+import queue
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 
 DEFAULT_LOCATION=os.getcwd()
-RPM_APICALL_LIMIT=10
-DB_FILE_NAME="scheduleDB.json"
+#Token bucket limits, (requests per second, burst) by service or by (region, service)
+RATE_LIMITS={
+    'compute': (10, 20),
+    'database': (5, 10),
+    'identity': (10, 20),
+}
+DEFAULT_RATE_LIMIT=(5, 10)
+#On a 429 the bucket rate is multiplied by this factor, and restored after the recovery period
+THROTTLE_FACTOR=0.5
+THROTTLE_MIN_FRACTION=0.1
+THROTTLE_RECOVERY_SECONDS=30
+#Token buckets shared by every ocicron process of the host, one file per tenancy, region and service
+#None keeps a private bucket in each process
+RATE_LIMIT_DIR=os.path.join(DEFAULT_LOCATION, '.ocicron_limits')
+#Lifecycle states where an action has nothing left to do, checked before a slot runs, by resource provider
+SKIP_STATES={
+    'compute': {
+        'START': {'RUNNING', 'STARTING'},
+        'SOFTSTOP': {'STOPPED', 'STOPPING'},
+        'STOP': {'STOPPED', 'STOPPING'},
+    },
+    'database': {
+        'START': {'AVAILABLE', 'STARTING'},
+        'STOP': {'STOPPED', 'STOPPING'},
+    },
+    'instance_pool': {
+        'START': {'RUNNING', 'STARTING'},
+        'STOP': {'STOPPED', 'STOPPING'},
+    },
+    'autonomous_database': {
+        'START': {'AVAILABLE', 'STARTING'},
+        'STOP': {'STOPPED', 'STOPPING'},
+    },
+}
+#Lifecycle state each action ends in, polled by the wait mode, by resource provider
+TARGET_STATES={
+    'compute': {'START': 'RUNNING', 'SOFTSTOP': 'STOPPED', 'STOP': 'STOPPED'},
+    'database': {'START': 'AVAILABLE', 'STOP': 'STOPPED'},
+    'instance_pool': {'START': 'RUNNING', 'STOP': 'STOPPED'},
+    'autonomous_database': {'START': 'AVAILABLE', 'STOP': 'STOPPED'},
+}
+#Seconds between two lifecycle state listings while waiting for a slot to complete
+WAIT_POLL_SECONDS=15
+#Instance principal token shared by every ocicron process of the host, None keeps it in memory only
+TOKEN_CACHE_FILE=os.path.join(DEFAULT_LOCATION, '.ocicron_token')
+#Seconds before expiry a cached token is refreshed
+TOKEN_REFRESH_MARGIN=300
+#Instance metadata service and federation endpoint, set them to use a local stand-in
+METADATA_URL_BASE=os.environ.get('OCICRON_METADATA_URL')
+FEDERATION_ENDPOINT=os.environ.get('OCICRON_FEDERATION_ENDPOINT')
+#Execution journals, one append-only file per slot run
+JOURNAL_DIR=os.path.join(DEFAULT_LOCATION, 'journal')
+#Journal records written between two fsyncs, and the longest time a record waits for one
+JOURNAL_SYNC_EVERY=50
+JOURNAL_SYNC_SECONDS=1.0
+#Journals kept per slot, older runs are removed when a new one starts
+JOURNAL_KEEP=10
+#Concurrent API calls while running a slot
+ACTION_WORKERS=10
+#Compartments scanned at the same time in a region
+DISCOVERY_WORKERS=8
+#'crawl' lists every resource of every compartment and keeps the tagged ones, 'search' asks the
+#resource search service for the tagged resources of a region in one query, and crawls when it fails
+DISCOVERY_BACKEND='crawl'
+#Results per page of the search query
+SEARCH_PAGE_SIZE=1000
+#API clients of a connection
+CLIENT_SERVICES=('compute', 'compute_management', 'identity', 'database', 'search')
+DB_FILE_NAME="scheduleDB.sqlite"
+#TinyDB store used by previous versions, imported with ocicron.py migrate
+JSON_DB_FILE_NAME="scheduleDB.json"
 TAG_KEYS={"Stop", "Start", "Weekend_stop"}
+#Order of the tag values in a grouping key
+TAG_KEY_ORDER=("Start", "Stop", "Weekend_stop")
+#Optional tags: Priority orders the actions of a slot, lower values first,
+#Deadline is the minutes after the slot fires by which its actions should be issued
+PRIORITY_TAG="Priority"
+DEADLINE_TAG="Deadline"
+#Priority of untagged resources, DB nodes start before and stop after the VMs of the applications using them
+DEFAULT_PRIORITY={
+    'database': 10,
+    'autonomous_database': 10,
+    'compute': 20,
+    'instance_pool': 20,
+}
+#Freeform tags kept on discovered resources, every other tag is dropped while listing
+RECORD_TAG_KEYS=TAG_KEY_ORDER + (PRIORITY_TAG, DEADLINE_TAG)
+#Resources handed over at a time from the compartment listings to the tag grouping
+STREAM_BATCH_SIZE=100
+#Expected seconds of one action call, used to size the worker pool for a deadline
+ACTION_CALL_SECONDS=1.0
+#Most workers a slot may use to meet its deadline
+MAX_ACTION_WORKERS=50
+#Upper bounds in seconds of the API call latency histogram buckets
+LATENCY_BUCKETS=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+#Directory of the metrics file each run writes, None disables them
+METRICS_DIR=os.path.join(DEFAULT_LOCATION, 'metrics')
+#'prometheus' writes a node exporter textfile collector file, 'json' a summary
+METRICS_FORMAT='prometheus'
 
-#Logging
-logging.basicConfig(filename='ocicron.log', level=logging.INFO, format='%(asctime)s :: %(levelname)s :: %(message)s')
-
-#Fix Too Many request error
-custom_retry_strategy = oci.retry.RetryStrategyBuilder(
-    # Whether to enable a check that we don't exceed a certain number of attempts
-    max_attempts_check=True,
-    # check that will retry on connection errors, timeouts and service errors 
-    service_error_check=True,
-    # a check that we don't exceed a certain amount of time retrying
-    total_elapsed_time_check=True,
-    # maximum number of attempts
-    max_attempts=10,
-    # don't exceed a total of 900 seconds for all calls
-    total_elapsed_time_seconds=900,
-    # if we are checking o service errors, we can configure what HTTP statuses to retry on
-    # and optionally whether the textual code (e.g. TooManyRequests) matches a given value
-    service_error_retry_config={
-        400: ['QuotaExceeded', 'LimitExceeded'],
-        429: []
-    },
-    # whether to retry on HTTP 5xx errors
-    service_error_retry_on_any_5xx=True,
-    # Used for exponention backoff with jitter
-    retry_base_sleep_time_seconds=2,
-    # Wait 60 seconds between attempts
-    retry_max_wait_between_calls_seconds=60,
-    # the type of backoff
-    # Accepted values are: BACKOFF_FULL_JITTER_VALUE, BACKOFF_EQUAL_JITTER_VALUE, BACKOFF_FULL_JITTER_EQUAL_ON_THROTTLE_VALUE
-    backoff_type=oci.retry.BACKOFF_FULL_JITTER_EQUAL_ON_THROTTLE_VALUE
-).get_retry_strategy()
+LOG_FILE='ocicron.log'
+LOG_FORMAT='%(asctime)s :: %(levelname)s :: %(message)s'
+#Write JSON lines with the structured fields of each record, False writes LOG_FORMAT text lines
+LOG_JSON=True
+#INFO logs a summary per phase and slot, DEBUG adds a line per resource grouped and per action issued
+LOG_LEVEL=os.environ.get('OCICRON_LOG_LEVEL', 'INFO')
+#Structured fields of a record, given with extra= or by log_context()
+LOG_FIELDS=('slot', 'region', 'service', 'ocid', 'action', 'phase')
+
+
+_log_context = threading.local()
+
+@contextmanager
+def log_context(**fields):
+    """
+    Add structured fields to every record this thread logs inside the block
+    """
+    previous = getattr(_log_context, 'fields', {})
+    _log_context.fields = dict(previous, **fields)
+    try:
+        yield
+    finally:
+        _log_context.fields = previous
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format a record as a JSON line with its structured fields
+    """
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'message': record.getMessage()}
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """
+    Queue records for the writer thread, keeping their structured fields
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        for field, value in getattr(_log_context, 'fields', {}).items():
+            if getattr(record, field, None) is None:
+                setattr(record, field, value)
+        #tracebacks are formatted in the thread that logged them
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_log_listener = None
+_log_handler = None
+
+def setup_logging(filename=None, level=None):
+    """
+    Configure the ocicron log file, LOG_FILE by default, called by the CLI instead of at import time.
+    Records are queued and written by a background thread, so hot loops never wait on the file
+    """
+    global _log_listener, _log_handler
+    if _log_listener is not None:
+        return
+    handler = logging.FileHandler(LOG_FILE if filename is None else filename)
+    handler.setFormatter(JsonFormatter() if LOG_JSON else logging.Formatter(LOG_FORMAT))
+    _log_listener = logging.handlers.QueueListener(queue.Queue(), handler)
+    _log_handler = AsyncLogHandler(_log_listener.queue)
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL if level is None else level)
+    root.addHandler(_log_handler)
+    #keep the HTTP chatter of the SDK out of the DEBUG log
+    for name in ('oci', 'urllib3'):
+        logging.getLogger(name).setLevel(logging.INFO)
+    _log_listener.start()
+    #write the queued records before the process exits
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """
+    Write every queued record and stop the writer thread
+    """
+    global _log_listener, _log_handler
+    if _log_listener is None:
+        return
+    logging.getLogger().removeHandler(_log_handler)
+    _log_listener.stop()
+    for handler in _log_listener.handlers:
+        handler.close()
+    _log_listener = None
+    _log_handler = None
+
+
+_retry_strategy = None
+
+def get_retry_strategy():
+    """
+    Build the retry strategy on first use so importing this module doesn't import the SDK
+    """
+    global _retry_strategy
+    if _retry_strategy is None:
+        import oci
+        #Fix Too Many request error
+        _retry_strategy = oci.retry.RetryStrategyBuilder(
+            # Whether to enable a check that we don't exceed a certain number of attempts
+            max_attempts_check=True,
+            # check that will retry on connection errors, timeouts and service errors 
+            service_error_check=True,
+            # a check that we don't exceed a certain amount of time retrying
+            total_elapsed_time_check=True,
+            # maximum number of attempts
+            max_attempts=10,
+            # don't exceed a total of 900 seconds for all calls
+            total_elapsed_time_seconds=900,
+            # if we are checking o service errors, we can configure what HTTP statuses to retry on
+            # and optionally whether the textual code (e.g. TooManyRequests) matches a given value
+            service_error_retry_config={
+                400: ['QuotaExceeded', 'LimitExceeded'],
+                429: []
+            },
+            # whether to retry on HTTP 5xx errors
+            service_error_retry_on_any_5xx=True,
+            # Used for exponention backoff with jitter
+            retry_base_sleep_time_seconds=2,
+            # Wait 60 seconds between attempts
+            retry_max_wait_between_calls_seconds=60,
+            # the type of backoff
+            # Accepted values are: BACKOFF_FULL_JITTER_VALUE, BACKOFF_EQUAL_JITTER_VALUE, BACKOFF_FULL_JITTER_EQUAL_ON_THROTTLE_VALUE
+            backoff_type=oci.retry.BACKOFF_FULL_JITTER_EQUAL_ON_THROTTLE_VALUE
+        ).get_retry_strategy()
+    return _retry_strategy
+
+
+class LazyObject:
+    """
+    Proxy that creates the wrapped object on first attribute access
+    """
+
+    def __init__(self, factory, *args, **kwargs):
+        self._factory = factory
+        self._args = args
+        self._kwargs = kwargs
+        self._obj = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._obj is None:
+            with self._lock:
+                if self._obj is None:
+                    self._obj = self._factory(*self._args, **self._kwargs)
+        return getattr(self._obj, name)
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket, callers only wait when the budget is actually spent
+    """
+
+    def __init__(self, rate, burst):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.throttled_at = None
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        #Recover the configured rate step by step once 429s stop
+        if self.throttled_at is not None and now - self.throttled_at >= THROTTLE_RECOVERY_SECONDS:
+            self.rate = min(self.max_rate, self.rate / THROTTLE_FACTOR)
+            self.throttled_at = None if self.rate >= self.max_rate else now
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens from the bucket, return the seconds spent waiting for them
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    self.waited += waited
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def throttle(self):
+        """
+        Slow the bucket down after the service answered 429
+        """
+        with self.lock:
+            self.rate = max(self.max_rate * THROTTLE_MIN_FRACTION, self.rate * THROTTLE_FACTOR)
+            self.tokens = 0.0
+            self.throttled_at = time.monotonic()
+            logging.warning("Throttled by the service, rate lowered to {:.2f} requests/s".format(self.rate))
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket kept in a file under an flock, so concurrent ocicron processes
+    split the same budget instead of each spending all of it
+    """
+
+    def __init__(self, path, rate, burst):
+        super().__init__(rate, burst)
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    @contextmanager
+    def _state(self):
+        """
+        Lock the bucket file, load it into the bucket and yield the stored state, written back on exit
+        """
+        with self.lock, open(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), 'r+') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                state = json.loads(handle.read() or '{}')
+            except ValueError:
+                state = {}
+            #wall clock time, the only clock every process agrees on
+            self.tokens = state.get('tokens', self.burst)
+            self.updated = state.get('updated', time.time())
+            self.rate = state.get('rate', self.max_rate)
+            self.throttled_at = state.get('throttled_at')
+            yield state
+            state.update(tokens=self.tokens, updated=self.updated, rate=self.rate, throttled_at=self.throttled_at)
+            handle.seek(0)
+            handle.truncate()
+            json.dump(state, handle)
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens from the shared bucket, return the seconds spent waiting for them
+        """
+        waited = 0.0
+        while True:
+            with self._state():
+                self._refill(time.time())
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    self.waited += waited
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def throttle(self):
+        """
+        Slow the bucket down for every process after the service answered 429
+        """
+        with self._state():
+            self.rate = max(self.max_rate * THROTTLE_MIN_FRACTION, self.rate * THROTTLE_FACTOR)
+            self.tokens = 0.0
+            self.throttled_at = time.time()
+        logging.warning("Throttled by the service, shared rate of {} lowered to {:.2f} requests/s".format(os.path.basename(self.path), self.rate))
+
+
+def rate_limit(region, service):
+    """
+    Return the configured (requests per second, burst) of a region and service
+    """
+    return RATE_LIMITS.get((region, service), RATE_LIMITS.get(service, DEFAULT_RATE_LIMIT))
+
+def min_slot_seconds(counts, region):
+    """
+    Shortest time the API budget allows to issue a number of actions per resource provider in a region,
+    each API service has its own bucket so they are issued in parallel
+    counts = {provider name: actions}
+    """
+    by_service = {}
+    for name, count in counts.items():
+        service = PROVIDERS[name].service
+        by_service[service] = by_service.get(service, 0) + count
+    seconds = 0.0
+    for service, count in by_service.items():
+        rate, burst = rate_limit(region, service)
+        seconds = max(seconds, max(0, count - burst) / rate)
+    return seconds
+
+def tag_priority(resource, service='compute'):
+    """
+    Priority tag of a resource, the service default when missing or not a number
+    """
+    value = resource.freeform_tags.get(PRIORITY_TAG)
+    try:
+        return int(value) if value is not None else DEFAULT_PRIORITY.get(service, 0)
+    except ValueError:
+        logging.warning("Invalid {} tag: {} on {}".format(PRIORITY_TAG, value, resource.id))
+        return DEFAULT_PRIORITY.get(service, 0)
+
+def tag_deadline(resource):
+    """
+    Deadline tag of a resource in minutes, None when missing or not a number
+    """
+    value = resource.freeform_tags.get(DEADLINE_TAG)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        logging.warning("Invalid {} tag: {} on {}".format(DEADLINE_TAG, value, resource.id))
+        return None
+
+
+def iter_pages(list_func, **kwargs):
+    """
+    Yield the items of a paginated list call, one page is held at a time
+    """
+    response = list_func(**kwargs)
+    while True:
+        for item in response.data:
+            yield item
+        if not response.has_next_page:
+            return
+        response = list_func(page=response.next_page, **kwargs)
+
+
+class ResourceRecord:
+    """
+    Compact projection of a listed SDK model, with only the fields and tags ocicron uses
+    """
+    __slots__ = ('id', 'compartment_id', 'lifecycle_state', 'display_name', 'freeform_tags')
+
+    def __init__(self, model):
+        self.id = model.id
+        self.compartment_id = model.compartment_id
+        self.lifecycle_state = model.lifecycle_state
+        self.display_name = model.display_name
+        tags = model.freeform_tags or {}
+        self.freeform_tags = {k: tags[k] for k in RECORD_TAG_KEYS if k in tags}
+
+    @classmethod
+    def from_search(cls, summary):
+        """
+        Project a resource search result, which names the OCID identifier
+        """
+        record = cls.__new__(cls)
+        record.id = summary.identifier
+        record.compartment_id = summary.compartment_id
+        record.lifecycle_state = summary.lifecycle_state
+        record.display_name = summary.display_name
+        tags = summary.freeform_tags or {}
+        record.freeform_tags = {k: tags[k] for k in RECORD_TAG_KEYS if k in tags}
+        return record
+
+
+class NodeRecord:
+    """
+    Compact projection of a listed DB node
+    """
+    __slots__ = ('id', 'db_system_id', 'lifecycle_state')
+
+    def __init__(self, model):
+        self.id = model.id
+        self.db_system_id = model.db_system_id
+        self.lifecycle_state = model.lifecycle_state
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(region, service, tenancy='default'):
+    """
+    Return the token bucket of a given tenancy, region and service
+    shared with the other processes of the host when RATE_LIMIT_DIR is set
+    """
+    key = (tenancy, region, service)
+    with _limiters_lock:
+        if key not in _limiters:
+            rate, burst = rate_limit(region, service)
+            if RATE_LIMIT_DIR is None:
+                _limiters[key] = TokenBucket(rate, burst)
+            else:
+                path = os.path.join(RATE_LIMIT_DIR, '{}.{}.{}'.format(tenancy, region, service))
+                _limiters[key] = SharedTokenBucket(path, rate, burst)
+        return _limiters[key]
+
+class Metrics:
+    """
+    Thread safe metrics of one run: latency histogram, pages, retries, 429s and
+    rate limiter wait of every API operation, and the time spent in each phase
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #labels added to every series, like the command and the slot of the run
+        self.labels = {}
+        #(service, operation) -> counters
+        self.operations = {}
+        #phase -> seconds
+        self.phases = {}
+        self.started = time.time()
+        #counters of the API call running in each thread, updated by its retry strategy
+        self.local = threading.local()
+
+    def call(self, service, operation, func, *args, **kwargs):
+        """
+        Run an API call and record it with the attempts its retry strategy made
+        """
+        current = {'attempts': 0, 'throttled': 0, 'wait': 0.0}
+        self.local.call = current
+        status = None
+        start = time.monotonic()
+        try:
+            response = func(*args, **kwargs)
+            status = getattr(response, 'status', None)
+            return response
+        except Exception as err:
+            status = getattr(err, 'status', None) or 'error'
+            raise
+        finally:
+            self.local.call = None
+            self._observe(service, operation, time.monotonic() - start, status, current)
+
+    def attempt(self, waited):
+        """
+        Record one attempt of the API call of this thread and the seconds it waited for the limiter
+        """
+        self.local.waited = self.thread_wait() + waited
+        current = getattr(self.local, 'call', None)
+        if current is not None:
+            current['attempts'] += 1
+            current['wait'] += waited
+
+    def thread_wait(self):
+        """
+        Seconds the API calls of this thread waited for the rate limiters
+        """
+        return getattr(self.local, 'waited', 0.0)
+
+    def throttled(self):
+        """
+        Record a 429 answer to the API call of this thread
+        """
+        current = getattr(self.local, 'call', None)
+        if current is not None:
+            current['throttled'] += 1
+
+    def _observe(self, service, operation, seconds, status, current):
+        with self.lock:
+            stats = self.operations.get((service, operation))
+            if stats is None:
+                stats = self.operations[(service, operation)] = {
+                    'calls': 0, 'errors': 0, 'pages': 0, 'retries': 0, 'throttled': 0, 'limiter_wait': 0.0,
+                    'latency_sum': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+            stats['calls'] += 1
+            if not isinstance(status, int) or status >= 400:
+                stats['errors'] += 1
+            elif operation.startswith('list_'):
+                stats['pages'] += 1
+            stats['retries'] += max(0, current['attempts'] - 1)
+            stats['throttled'] += current['throttled']
+            stats['limiter_wait'] += current['wait']
+            stats['latency_sum'] += seconds
+            index = len(LATENCY_BUCKETS)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    index = i
+                    break
+            stats['buckets'][index] += 1
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Add the time spent in the block to a phase
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+            logging.info("Phase {} -- {:.1f}s".format(name, elapsed), extra={'phase': name})
+
+    def summary(self):
+        """
+        Return the metrics of the run as a dictionary
+        """
+        with self.lock:
+            operations = {}
+            totals = {'calls': 0, 'errors': 0, 'pages': 0, 'retries': 0, 'throttled': 0, 'limiter_wait': 0.0}
+            for (service, operation), stats in sorted(self.operations.items()):
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), stats['buckets']):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                operations['{}.{}'.format(service, operation)] = dict(
+                    {key: stats[key] for key in totals}, latency_sum=stats['latency_sum'], latency_buckets=buckets)
+                for key in totals:
+                    totals[key] += stats[key]
+            return {'labels': dict(self.labels), 'started': self.started, 'phases': dict(self.phases),
+                'totals': totals, 'operations': operations}
+
+    def prometheus(self):
+        """
+        Return the metrics of the run in the Prometheus text format
+        """
+        summary = self.summary()
+
+        def labels(**extra):
+            pairs = dict(summary['labels'], **extra)
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs.items()) + '}'
+
+        counters = (
+            ('calls', 'ocicron_api_calls_total', 'API calls, retries excluded'),
+            ('errors', 'ocicron_api_errors_total', 'API calls that failed after their retries'),
+            ('pages', 'ocicron_api_pages_total', 'Pages read by list operations'),
+            ('retries', 'ocicron_api_retries_total', 'Attempts retried by the retry strategy'),
+            ('throttled', 'ocicron_api_throttled_total', 'Attempts answered with 429'),
+            ('limiter_wait', 'ocicron_rate_limiter_wait_seconds_total', 'Seconds spent waiting for the rate limiter'),
+        )
+        lines = []
+        for key, name, description in counters:
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} counter'.format(name))
+            for operation, stats in summary['operations'].items():
+                service, operation = operation.split('.', 1)
+                lines.append('{}{} {}'.format(name, labels(service=service, operation=operation), stats[key]))
+        name = 'ocicron_api_call_duration_seconds'
+        lines.append('# HELP {} Latency of API calls, retries included'.format(name))
+        lines.append('# TYPE {} histogram'.format(name))
+        for operation, stats in summary['operations'].items():
+            service, operation = operation.split('.', 1)
+            for bound, count in stats['latency_buckets'].items():
+                lines.append('{}_bucket{} {}'.format(name, labels(service=service, operation=operation, le=bound), count))
+            lines.append('{}_sum{} {}'.format(name, labels(service=service, operation=operation), stats['latency_sum']))
+            lines.append('{}_count{} {}'.format(name, labels(service=service, operation=operation), stats['calls']))
+        name = 'ocicron_phase_duration_seconds'
+        lines.append('# HELP {} Seconds spent in each phase of the run'.format(name))
+        lines.append('# TYPE {} gauge'.format(name))
+        for phase, seconds in sorted(summary['phases'].items()):
+            lines.append('{}{} {}'.format(name, labels(phase=phase), seconds))
+        name = 'ocicron_run_timestamp_seconds'
+        lines.append('# HELP {} Start time of the run'.format(name))
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{}{} {}'.format(name, labels(), summary['started']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, name):
+        """
+        Write the metrics of the run to METRICS_DIR, replacing the file of the previous run with the same name
+        return the path of the file, None when metrics are disabled
+        """
+        if METRICS_DIR is None:
+            return None
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        if METRICS_FORMAT == 'json':
+            path = os.path.join(METRICS_DIR, 'ocicron_{}.json'.format(name))
+            content = json.dumps(self.summary(), indent=2, sort_keys=True)
+        else:
+            path = os.path.join(METRICS_DIR, 'ocicron_{}.prom'.format(name))
+            content = self.prometheus()
+        #the textfile collector must never read a partial file
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(content)
+        os.replace(tmp, path)
+        return path
+
+
+#Metrics of the run of this process
+metrics = Metrics()
+
+
+class InstrumentedClient:
+    """
+    Wrap an API client so every call is recorded in the metrics of the run
+    """
+
+    def __init__(self, client, service):
+        self.client = client
+        self.service = service
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            return metrics.call(self.service, name, attr, *args, **kwargs)
+        #wrap each operation once
+        self.__dict__[name] = call
+        return call
+
+
+class RateLimitedRetryStrategy:
+    """
+    Wrap an oci retry strategy so every attempt, retries included, takes a token
+    from the limiter and every 429 seen by the strategy slows the limiter down
+    """
+
+    def __init__(self, strategy, limiter):
+        self.strategy = strategy
+        self.limiter = limiter
+
+    def make_retrying_call(self, func_ref, *func_args, **func_kwargs):
+        def limited_call(*args, **kwargs):
+            metrics.attempt(self.limiter.acquire())
+            try:
+                return func_ref(*args, **kwargs)
+            except Exception as err:
+                if getattr(err, 'status', None) == 429:
+                    self.limiter.throttle()
+                    metrics.throttled()
+                raise
+        return self.strategy.make_retrying_call(limited_call, *func_args, **func_kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.strategy, name)
+
+
+def percentile(values, rank):
+    """
+    Nearest-rank percentile of a list of numbers, None when it is empty
+    """
+    if len(values) <= 0:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, -(-len(ordered) * rank // 100) - 1)]
+
+
+def completion_report(label, reached, stragglers, deadline):
+    """
+    Log and return the time each resource of a slot took to reach its target state,
+    as percentiles, and the resources still not there at the deadline
+    """
+    times = list(reached.values())
+    report = {'slot': label, 'completed': len(reached), 'stragglers': stragglers, 'deadline': deadline}
+    for rank in (50, 90, 99, 100):
+        report['p{}'.format(rank)] = percentile(times, rank)
+    if len(times) > 0:
+        logging.info("Slot {} - completed: {}, stragglers: {}, time to target state p50: {:.0f}s, p90: {:.0f}s, p99: {:.0f}s, max: {:.0f}s".format(
+            label, len(reached), len(stragglers), report['p50'], report['p90'], report['p99'], report['p100']))
+    else:
+        logging.info("Slot {} - completed: 0, stragglers: {}".format(label, len(stragglers)))
+    for ocid, state in sorted(stragglers.items()):
+        logging.warning("Slot {} - straggler after {}s: {} - last state: {}".format(label, deadline, ocid, state))
+    return report
+
+
+class ExecutionJournal:
+    """
+    Append-only record of a slot run, one JSON line per OCID and status:
+    'issued' before the API call, then 'accepted' or 'failed' with its outcome.
+    Lines are fsynced in batches, a torn last line left by a crash is ignored on load,
+    every JOURNAL_SYNC_EVERY records or JOURNAL_SYNC_SECONDS by default
+    """
+
+    def __init__(self, path, sync_every=None, sync_seconds=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        #slot of the run, set by for_slot
+        self.slot = None
+        self.sync_every = JOURNAL_SYNC_EVERY if sync_every is None else sync_every
+        self.sync_seconds = JOURNAL_SYNC_SECONDS if sync_seconds is None else sync_seconds
+        self.outcomes = self.load(path)
+        self.handle = open(path, 'a')
+        #end a torn last line before appending to a previous run
+        if self.handle.tell() > 0:
+            with open(path, 'rb') as previous:
+                previous.seek(-1, os.SEEK_END)
+                if previous.read(1) != b'\n':
+                    self.handle.write('\n')
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_slot(cls, slot, mode='new', location=None):
+        """
+        Open the journal of a slot run in location (JOURNAL_DIR by default), mode 'new' starts a new run,
+        'resume' and 'retry' continue the latest run of the slot, None when there is none
+        """
+        location = JOURNAL_DIR if location is None else location
+        prefix = os.path.join(location, slot.replace(':', '_'))
+        runs = sorted(glob.glob(glob.escape(prefix) + '.*.journal'))
+        if mode != 'new':
+            journal = cls(runs[-1]) if len(runs) > 0 else None
+        else:
+            for old in runs[:max(0, len(runs) - JOURNAL_KEEP + 1)]:
+                os.remove(old)
+            journal = cls('{}.{}.journal'.format(prefix, time.strftime('%Y%m%dT%H%M%S')))
+        if journal is not None:
+            journal.slot = slot
+        return journal
+
+    @staticmethod
+    def load(path):
+        """
+        Return a dictionary of OCID -> last status recorded in a journal
+        """
+        outcomes = {}
+        if not os.path.exists(path):
+            return outcomes
+        with open(path) as handle:
+            for line in handle:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                outcomes[record['ocid']] = record['status']
+        return outcomes
+
+    def remaining(self, resources, mode):
+        """
+        Filter slot resources for a mode, 'resume' keeps every resource not accepted yet,
+        'retry' only the ones that failed, 'new' keeps them all
+        """
+        if mode == 'resume':
+            return [r for r in resources if self.outcomes.get(r['ocid']) != 'accepted']
+        if mode == 'retry':
+            return [r for r in resources if self.outcomes.get(r['ocid']) == 'failed']
+        return resources
+
+    def record(self, ocid, status, action=None):
+        line = json.dumps({'ocid': ocid, 'status': status, 'action': action, 'time': time.time()})
+        with self.lock:
+            self.handle.write(line + '\n')
+            self.outcomes[ocid] = status
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.monotonic() - self.synced_at >= self.sync_seconds:
+                self._sync()
+
+    def _sync(self):
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+
+    def track(self, func):
+        """
+        Wrap an action func(ocid, action) returning True when issued, so each call is journaled
+        """
+        def tracked(ocid, action, *args):
+            self.record(ocid, 'issued', action)
+            #actions run on worker threads, records they log carry the slot of the journal
+            with log_context(slot=self.slot):
+                issued = func(ocid, action, *args)
+            self.record(ocid, 'accepted' if issued else 'failed', action)
+            return issued
+        return tracked
+
+    def close(self):
+        with self.lock:
+            if not self.handle.closed:
+                self._sync()
+                self.handle.close()
+
+
+class ActionEngine:
+    """
+    Run queued actions on a bounded worker pool and report slot wall time and throughput,
+    ACTION_WORKERS workers by default
+    """
+
+    def __init__(self, workers=None):
+        self.workers = ACTION_WORKERS if workers is None else workers
+        self.tasks = []
+        self.skipped = 0
+        self.journals = []
+
+    def attach(self, journal, done=None):
+        """
+        Close a journal once the queued actions have run, done(journal) is called before
+        with every outcome of the journal recorded
+        """
+        self.journals.append((journal, done))
+
+    def skip(self, count):
+        """
+        Count resources left out of the slot because they are already in the target state
+        """
+        self.skipped += count
+
+    def submit(self, func, *args, priority=0):
+        """
+        Queue func(*args), func must return True when the action was issued,
+        tasks with a lower priority value are started first
+        """
+        self.tasks.append((priority, func, args))
+
+    def size_for_deadline(self, actions, deadline, rate):
+        """
+        Raise the number of workers so a number of actions can be issued within deadline seconds,
+        no more than the rate limit (requests per second) can keep busy
+        """
+        useful = min(MAX_ACTION_WORKERS, int(rate * ACTION_CALL_SECONDS) + 1)
+        needed = -(-int(actions * ACTION_CALL_SECONDS) // max(1, int(deadline)))
+        self.workers = max(self.workers, min(useful, needed))
+
+    def run(self, label=''):
+        try:
+            return self._run(label)
+        finally:
+            journals, self.journals = self.journals, []
+            for journal, done in journals:
+                try:
+                    if done is not None:
+                        done(journal)
+                except Exception:
+                    logging.error("Exception occurred completing journal {}".format(journal.path), exc_info=True)
+                finally:
+                    journal.close()
+
+    def _run(self, label):
+        tasks, self.tasks = sorted(self.tasks, key=lambda task: task[0]), []
+        report = {'slot': label, 'actions': len(tasks), 'skipped': self.skipped, 'issued': 0, 'failed': 0, 'wall_time': 0.0, 'throughput': 0.0, 'rate_limit_wait': 0.0, 'blocked_share': 0.0}
+        self.skipped = 0
+        if len(tasks) <= 0:
+            logging.info("Slot {} - actions: 0, skipped: {}".format(label, report['skipped']))
+            return report
+
+        #the waits of this engine tasks only, other slots may share the limiters
+        def timed(task):
+            waited = metrics.thread_wait()
+            issued = task[1](*task[2])
+            return issued, metrics.thread_wait() - waited
+
+        workers = min(self.workers, len(tasks))
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for issued, waited in pool.map(timed, tasks):
+                if issued:
+                    report['issued'] += 1
+                else:
+                    report['failed'] += 1
+                report['rate_limit_wait'] += waited
+        report['wall_time'] = time.monotonic() - start
+        if report['wall_time'] > 0:
+            report['throughput'] = report['actions'] / report['wall_time']
+            report['blocked_share'] = report['rate_limit_wait'] / (report['wall_time'] * workers)
+
+        logging.info("Slot {} - actions: {}, skipped: {}, issued: {}, failed: {}, wall time: {:.1f}s, throughput: {:.2f} actions/s, rate limit wait: {:.1f}s summed over {} workers, {:.0%} of their time".format(
+            label, report['actions'], report['skipped'], report['issued'], report['failed'], report['wall_time'], report['throughput'],
+            report['rate_limit_wait'], workers, report['blocked_share']))
+        return report
+
+
+def instance_principals_signer(metadata_url_base=None, federation_endpoint=None):
+    """
+    Build an instance principal signer, the metadata service and federation endpoint
+    can point to a local stand-in
+    """
+    import oci
+    metadata_url_base = metadata_url_base or METADATA_URL_BASE
+    federation_endpoint = federation_endpoint or FEDERATION_ENDPOINT
+    signer_class = oci.auth.signers.InstancePrincipalsSecurityTokenSigner
+    if not metadata_url_base:
+        return signer_class(federation_endpoint=federation_endpoint)
+
+    base = metadata_url_base.rstrip('/')
+    #older SDKs only read the class attributes
+    signer_class = type('LocalInstancePrincipalsSecurityTokenSigner', (signer_class,), {
+        'METADATA_URL_BASE': base,
+        'GET_REGION_URL': '{}/instance/region'.format(base),
+        'LEAF_CERTIFICATE_URL': '{}/identity/cert.pem'.format(base),
+        'LEAF_CERTIFICATE_PRIVATE_KEY_URL': '{}/identity/key.pem'.format(base),
+        'INTERMEDIATE_CERTIFICATE_URL': '{}/identity/intermediate.pem'.format(base),
+    })
+    #newer ones read the environment while the signer is built, the variable of the process is put back after
+    previous = os.environ.get('OCI_METADATA_BASE_URL')
+    os.environ['OCI_METADATA_BASE_URL'] = base
+    try:
+        return signer_class(federation_endpoint=federation_endpoint)
+    finally:
+        if previous is None:
+            del os.environ['OCI_METADATA_BASE_URL']
+        else:
+            os.environ['OCI_METADATA_BASE_URL'] = previous
+
+
+def _token_expiry(token):
+    """
+    Return the exp claim of a JWT security token
+    """
+    payload = token.split('.')[1]
+    payload += '=' * (-len(payload) % 4)
+    return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+
+
+class TokenCache:
+    """
+    Instance principal security token shared across regions and processes
+
+    The token and its session key are kept in a file only readable by its owner,
+    guarded by a file lock, and only fetched again when close to expiry.
+    The file and refresh margin default to TOKEN_CACHE_FILE and TOKEN_REFRESH_MARGIN
+    """
+
+    def __init__(self, location=None, signer_factory=instance_principals_signer, margin=None):
+        #TOKEN_CACHE_FILE set to None keeps the token in memory only
+        self.location = TOKEN_CACHE_FILE if location is None else location
+        self.signer_factory = signer_factory
+        self.margin = TOKEN_REFRESH_MARGIN if margin is None else margin
+        self.lock = threading.Lock()
+        self.memory = None
+
+    def expiring(self, expires_at):
+        return expires_at - self.margin <= time.time()
+
+    def _fetch(self):
+        from cryptography.hazmat.primitives import serialization
+        signer = self.signer_factory()
+        token = signer.federation_client.get_security_token()
+        private_key = signer.federation_client.session_key_supplier.get_key_pair()['private']
+        logging.info("Instance principal token fetched for region: {}".format(signer.region))
+        return {
+            'token': token,
+            'private_key': private_key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()).decode('utf-8'),
+            'tenancy_id': signer.tenancy_id,
+            'region': signer.region,
+            'expires_at': _token_expiry(token),
+        }
+
+    def _read(self):
+        try:
+            info = os.stat(self.location)
+            #never trust a file other users could have written or read
+            if info.st_uid != os.getuid() or info.st_mode & 0o077:
+                logging.warning("Ignoring token cache with unsafe permissions: {}".format(self.location))
+                return None
+            with open(self.location) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, entry):
+        tmp = '{}.tmp'.format(self.location)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, self.location)
+
+    def entry(self):
+        """
+        Return a valid token entry, reusing the one another process already fetched
+        """
+        with self.lock:
+            if self.location is None:
+                if self.memory is None or self.expiring(self.memory['expires_at']):
+                    self.memory = self._fetch()
+                return self.memory
+
+            fd = os.open('{}.lock'.format(self.location), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                cached = self._read()
+                if cached is None or self.expiring(cached['expires_at']):
+                    cached = self._fetch()
+                    self._write(cached)
+                return cached
+            finally:
+                os.close(fd)
+
+
+_cached_token_signer_class = None
+
+def CachedTokenSigner(cache):
+    """
+    Request signer using the security token of a TokenCache, refreshed shortly before it expires
+    the class derives from the SDK SecurityTokenSigner, so it is only built once the SDK is imported
+    """
+    global _cached_token_signer_class
+    if _cached_token_signer_class is None:
+        import oci
+
+        class _CachedTokenSigner(oci.auth.signers.SecurityTokenSigner):
+
+            def __init__(self, cache):
+                self.cache = cache
+                self.lock = threading.Lock()
+                entry = cache.entry()
+                super().__init__(entry['token'], oci.signer.load_private_key(entry['private_key'], None))
+                self._set_entry(entry)
+
+            def _set_entry(self, entry):
+                self.tenancy_id = entry['tenancy_id']
+                self.region = entry['region']
+                self.expires_at = entry['expires_at']
+
+            def _refresh(self):
+                with self.lock:
+                    if not self.cache.expiring(self.expires_at):
+                        return
+                    entry = self.cache.entry()
+                    self.api_key = oci.auth.signers.security_token_signer.SECURITY_TOKEN_FORMAT_STRING.format(entry['token'])
+                    self.private_key = oci.signer.load_private_key(entry['private_key'], None)
+                    self._basic_signer.reset_signer(self.api_key, self.private_key)
+                    self._body_signer.reset_signer(self.api_key, self.private_key)
+                    self._set_entry(entry)
+
+            def __call__(self, request, enforce_content_headers=True):
+                self._refresh()
+                return super().__call__(request, enforce_content_headers)
+
+        _cached_token_signer_class = _CachedTokenSigner
+    return _cached_token_signer_class(cache)
+
+
+_signer = None
+_signer_lock = threading.Lock()
+
+def get_signer():
+    """
+    Return the instance principal signer shared by every connection of the process
+    """
+    global _signer
+    with _signer_lock:
+        if _signer is None:
+            _signer = CachedTokenSigner(TokenCache())
+        return _signer
 
 
 class OCI:
 
-    def __init__(self, auth_type, config_file="~/.oci/config", profile="DEFAULT", region=None):
+    def __init__(self, auth_type, config_file="~/.oci/config", profile="DEFAULT", region=None, workers=None, clients=None):
+        #the SDK is only imported when a connection is needed
+        import oci
+        #stand-in API clients, for example a FakeTenancy from ocicron_fake
+        self.clients = clients
         self.auth_type = auth_type
         self.config_file = config_file
         self.profile = profile
         self.region = region
+        #compartments listed in parallel
+        self.workers = DISCOVERY_WORKERS if workers is None else workers
 
-        if self.auth_type == "principal":
-            self.signer = oci.auth.signers.InstancePrincipalsSecurityTokenSigner()
+        if self.clients is not None:
+            for service in CLIENT_SERVICES:
+                setattr(self, service, self.clients.client(service, self.region, self._retry_strategy(service)))
+
+        elif self.auth_type == "principal":
+            #one token for every region and process, refreshed near expiry
+            self.signer = get_signer()
             if region is not None:
                 config = {'region':self.region}
             else:
                 config = {}            
-            self.compute = oci.core.ComputeClient(config=config, signer=self.signer, retry_strategy=custom_retry_strategy)
-            self.identity = oci.identity.IdentityClient(config=config, signer=self.signer, retry_strategy=custom_retry_strategy)
-            self.database = oci.database.DatabaseClient(config=config, signer=self.signer, retry_strategy=custom_retry_strategy)
+            self.compute = oci.core.ComputeClient(config=config, signer=self.signer, retry_strategy=self._retry_strategy('compute'))
+            self.compute_management = oci.core.ComputeManagementClient(config=config, signer=self.signer, retry_strategy=self._retry_strategy('compute_management'))
+            self.identity = oci.identity.IdentityClient(config=config, signer=self.signer, retry_strategy=self._retry_strategy('identity'))
+            self.database = oci.database.DatabaseClient(config=config, signer=self.signer, retry_strategy=self._retry_strategy('database'))
+            self.search = oci.resource_search.ResourceSearchClient(config=config, signer=self.signer, retry_strategy=self._retry_strategy('search'))
         
         elif self.auth_type == "config":
             self.config = oci.config.from_file(file_location=config_file, profile_name=profile)
             if self.region is not None:
                 self.config['region'] = self.region
-            self.compute = oci.core.ComputeClient(self.config, retry_strategy=custom_retry_strategy)
-            self.identity = oci.identity.IdentityClient(self.config, retry_strategy=custom_retry_strategy)
-            self.database = oci.database.DatabaseClient(self.config, retry_strategy=custom_retry_strategy)
+            self.compute = oci.core.ComputeClient(self.config, retry_strategy=self._retry_strategy('compute'))
+            self.compute_management = oci.core.ComputeManagementClient(self.config, retry_strategy=self._retry_strategy('compute_management'))
+            self.identity = oci.identity.IdentityClient(self.config, retry_strategy=self._retry_strategy('identity'))
+            self.database = oci.database.DatabaseClient(self.config, retry_strategy=self._retry_strategy('database'))
+            self.search = oci.resource_search.ResourceSearchClient(self.config, retry_strategy=self._retry_strategy('search'))
         
         else:
             logging.exception("Unrecognize authentication type: auth_type=(principal|config)")
+
+        #record every API call in the metrics of the run
+        for service in CLIENT_SERVICES:
+            if hasattr(self, service):
+                setattr(self, service, InstrumentedClient(getattr(self, service), service))
             
         
         self.suscribed_regions = []
         self.compartment_ids = []
-        self.compute_instances = []
-        self.db_systems = []
-        self.db_nodes = []
+        self.compartment_tree = {}
+        #one instance of every registered resource provider
+        self.providers = {name: provider(self) for name, provider in PROVIDERS.items()}
+
+    def _retry_strategy(self, service):
+        """
+        Retry strategy paced by the token bucket of this region and service
+        """
+        return RateLimitedRetryStrategy(get_retry_strategy(), get_limiter(self.region or 'home', service, self._tenancy_id()))
     
     def get_suscribed_regions(self):
 
-        if self.auth_type == "config":
-            response = self.identity.list_region_subscriptions(self.config['tenancy'])
-        else:
-            response = self.identity.list_region_subscriptions(self.signer.tenancy_id)
+        response = self.identity.list_region_subscriptions(self._tenancy_id())
         
         for r in response.data:
             self.suscribed_regions.append(r.region_name)
@@ -103,6 +1233,64 @@ class OCI:
                 if compartment.lifecycle_state == "ACTIVE" and compartment.id not in self.compartment_ids:
                         self.compartment_ids.append(compartment.id)
 
+    def _tenancy_id(self):
+        if self.clients is not None:
+            return self.clients.tenancy_id
+        if self.auth_type == "config":
+            return self.config['tenancy']
+        return self.signer.tenancy_id
+
+    def get_compartment_tree(self):
+        """
+        Fetch every active compartment of the tenancy in a single paginated subtree listing
+        return a dictionary of compartment id -> parent compartment id
+        """
+        tenancy_id = self._tenancy_id()
+        tree = {tenancy_id: None}
+        response = self.identity.list_compartments(
+            tenancy_id,
+            compartment_id_in_subtree=True,
+            access_level="ANY",
+            lifecycle_state="ACTIVE"
+        )
+        compartments = response.data
+        while response.has_next_page:
+            response = self.identity.list_compartments(
+                tenancy_id,
+                compartment_id_in_subtree=True,
+                access_level="ANY",
+                lifecycle_state="ACTIVE",
+                page=response.next_page
+            )
+            compartments.extend(response.data)
+
+        for compartment in compartments:
+            tree[compartment.id] = compartment.compartment_id
+        return tree
+
+    def use_compartment_tree(self, tree, roots=None):
+        """
+        Set compartment_ids to every compartment under the given roots, the whole tree by default
+        """
+        self.compartment_tree = tree
+        if not roots:
+            self.compartment_ids = list(tree)
+            return self.compartment_ids
+
+        children = {}
+        for cid, parent in tree.items():
+            children.setdefault(parent, []).append(cid)
+        found = set()
+        pending = [cid for cid in roots if cid in tree]
+        while pending:
+            cid = pending.pop()
+            if cid not in found:
+                found.add(cid)
+                pending.extend(children.get(cid, []))
+        #keep tree order
+        self.compartment_ids = [cid for cid in tree if cid in found]
+        return self.compartment_ids
+
     def compartment_crawler(self, comparments_id=None):
 
         if comparments_id is not None:
@@ -116,236 +1304,1229 @@ class OCI:
             self._get_sub_compartment_ids(cid)
         return self.compartment_ids
 
-    def get_all_instances(self):
+    def _map_compartments(self, func, compartment_ids=None):
         """
-        Return all instances in a given compartment
+        Call func on every given compartment, all known compartments by default,
+        using the discovery pool, results are returned in compartment order
         """
-        if len(self.compartment_ids) <= 0:
+        if compartment_ids is None:
+            compartment_ids = self.compartment_ids
+        if len(compartment_ids) <= 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(compartment_ids))) as pool:
+            return list(pool.map(func, compartment_ids))
+
+    def _stream_compartments(self, func, compartment_ids=None):
+        """
+        Yield the items of the generator func(compartment_id) of every given compartment,
+        all known compartments by default. Compartments are listed in parallel by the discovery pool
+        and their items handed over through a bounded queue, so memory doesn't grow with the tenancy
+        """
+        if compartment_ids is None:
+            compartment_ids = self.compartment_ids
+        if len(compartment_ids) <= 0:
             return
+        workers = min(self.workers, len(compartment_ids))
+        #batches of STREAM_BATCH_SIZE items, a couple per worker at most
+        items = queue.Queue(maxsize=2 * workers)
+        done = object()
+        stop = threading.Event()
 
-        for compartment_id in self.compartment_ids:   
-            response = self.compute.list_instances(
-                compartment_id=compartment_id,
-                sort_by="TIMECREATED",
-                sort_order="ASC"
-            )
-            #list instances with pagination
-            vms = response.data
-            while response.has_next_page:
-                response = self.compute.list_instances(compartment_id, page=response.next_page)
-                vms.extend(response.data)  
-
-            for vm in vms:
-                if vm.lifecycle_state == 'RUNNING' or vm.lifecycle_state == 'STOPPED':
-                    self.compute_instances.append(vm)         
-        return self.compute_instances
-    
-    #Return list of OCID of a given tag, key combination
-    def filter_by_tags(self, tags, service='compute'):
-        """
-        returns list if OCID of a given tags
-        tags = {"Stop":"20","Start": "08","Weekly_stop":"Yes"}
-        """
-        OCIDS=[]
-        if service == 'compute':
-            for vm in self.compute_instances:
-                #compare dictionary and length should be the same
-                if len(tags.items() & vm.freeform_tags.items()) == len(tags.items()):
-                    OCIDS.append(vm.id)
-                    logging.info("VM agregada:" + vm.display_name + " id: " + vm.id)
-                else:
-                    logging.info("VM descartada:" + vm.display_name )
-        elif service == 'database':
-            for db in self.db_systems:
-                if len(tags.items() & db.freeform_tags.items()) == len(tags.items()):
-                    OCIDS.append({"compartment_id": db.compartment_id, "ocid":db.id})
-                    logging.info("DB agregada:" + db.display_name + " id: " + db.id)
-                else:
-                    logging.info("DB descartada:" + db.display_name)
-        else:
-            logging.error("Unrecognize service: either compute or database are acccepted")
-        
-        return OCIDS
-    
-    # Discover all posible tag combinations found on freeform_tags
-    def _discover_tags(self, tag_keys=TAG_KEYS, service='compute'):
+        def produce(compartment_id):
+            try:
+                batch = []
+                for item in func(compartment_id):
+                    batch.append(item)
+                    if len(batch) >= STREAM_BATCH_SIZE:
+                        if stop.is_set():
+                            return
+                        items.put(batch)
+                        batch = []
+                if len(batch) > 0:
+                    items.put(batch)
+            finally:
+                items.put(done)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(produce, compartment_id) for compartment_id in compartment_ids]
+            running = len(futures)
+            try:
+                while running > 0:
+                    batch = items.get()
+                    if batch is done:
+                        running -= 1
+                    else:
+                        yield from batch
+            finally:
+                #let the producers finish when the consumer stops early
+                stop.set()
+                while running > 0:
+                    if items.get() is done:
+                        running -= 1
+            for future in futures:
+                future.result()
+
+    def lifecycle_states(self, resources, service='compute'):
         """
-        example: discover_tag({"Stop", "Start", "Weekly_stop"})
-        result: [{'Start': '08', 'Stop': '20', 'Weekly_stop': 'No'}, {'Start': '08', 'Stop': '21', 'Weekly_stop': 'Yes'}]
+        Current lifecycle state of the given resources of a provider, listed once per compartment
+        instead of a GET per resource
+        resources = [{'ocid': ..., 'compartment_id': ..., 'parent_id': ...}]
+        return a dictionary of OCID -> lifecycle state, every resource of the listed compartments included
         """
-        result = []
-        if service == 'compute':
-            for vm in self.compute_instances:
-                if len(tag_keys & vm.freeform_tags.keys()) == len(tag_keys):
-                    tags = {}
-                    for key in tag_keys:
-                        tags[key] = vm.freeform_tags[key]
-                    if tags not in result:
-                        result.append(tags)
-        elif service == 'database':
-            for db in self.db_systems:
-                if len(tag_keys & db.freeform_tags.keys()) == len(tag_keys):
-                    tags = {}
-                    for key in tag_keys:
-                        tags[key] = db.freeform_tags[key]
-                    if tags not in result:
-                        result.append(tags)
-        else:
-            logging.error("Unrecognize service: either compute or database are acccepted")
+        #DB systems of the db nodes of each compartment
+        parents = {}
+        for r in resources:
+            if r['compartment_id']:
+                parents.setdefault(r['compartment_id'], set()).add(r.get('parent_id'))
+        compartment_ids = sorted(parents)
 
-        return result
+        provider = self.providers[service]
+        states = {}
+        def compartment_states(compartment_id):
+            try:
+                return provider.states(compartment_id, parents[compartment_id])
+            except Exception as err:
+                logging.warning("Unable to check {} lifecycle states in compartment: {} - Error: {}".format(service, compartment_id, err))
+                return {}
+        for found in self._map_compartments(compartment_states, compartment_ids):
+            states.update(found)
+        return states
 
-    #return VMs OCIDs from al tags found
-    def vms_by_tags(self):   
+    def pending_actions(self, resources, action, service='compute'):
+        """
+        Pre-flight check before a slot runs
+        resources = [{'ocid': ..., 'compartment_id': ..., 'parent_id': ...}]
+        return OCIDs still needing the action, OCIDs skipped and the states found
+        """
+        states = self.lifecycle_states(resources, service)
+        done = SKIP_STATES.get(service, {}).get(action, set())
+        pending = []
+        skipped = []
+        found = {}
+        for r in resources:
+            state = states.get(r['ocid'])
+            if state is not None:
+                found[r['ocid']] = state
+            if state in done:
+                skipped.append(r['ocid'])
+            else:
+                pending.append(r['ocid'])
+        return pending, skipped, found
 
-        tags = self._discover_tags()
-        result = []
-        for tag in tags:
-            vm_group = {}
-            vm_group["tags"] = tag
-            vm_group["vmOCID"] = self.filter_by_tags(tag)
-            result.append(vm_group)
-        return result
+    def wait_for_states(self, targets, deadline, started=None, poll=None):
+        """
+        Poll the lifecycle state of every resource of a slot, every poll seconds (WAIT_POLL_SECONDS by default),
+        until each one reached the target state of its action or the deadline (seconds) passed
+        targets = [(resources, action, service)]
+        return a dictionary of OCID -> seconds since started it took to reach the target state,
+        and a dictionary of OCID -> last state seen for the stragglers
+        """
+        if started is None:
+            started = time.monotonic()
+        if poll is None:
+            poll = WAIT_POLL_SECONDS
+        waiting = {}
+        for resources, action, service in targets:
+            target = TARGET_STATES[service][action]
+            for r in resources:
+                waiting[r['ocid']] = (r, service, target)
+        reached = {}
+        last_seen = {}
+        while True:
+            #every service of the slot is listed in the same round
+            for service in sorted({service for _, service, _ in waiting.values()}):
+                resources = [r for r, s, _ in waiting.values() if s == service]
+                states = self.lifecycle_states(resources, service)
+                elapsed = time.monotonic() - started
+                for r in resources:
+                    ocid = r['ocid']
+                    last_seen[ocid] = states.get(ocid, last_seen.get(ocid))
+                    if last_seen[ocid] == waiting[ocid][2]:
+                        reached[ocid] = elapsed
+                        del waiting[ocid]
+            remaining = deadline - (time.monotonic() - started)
+            if len(waiting) <= 0 or remaining <= 0:
+                return reached, {ocid: last_seen.get(ocid) for ocid in waiting}
+            #the last check happens at the deadline
+            time.sleep(min(poll, remaining))
 
-    def instance_action(self, instance_ids, action):
+    def discover(self, names=None):
         """
-        Perform a given intance action of a given list of VM OCID
+        Run the discovery of the given providers, all registered ones by default, in parallel
+        return a dictionary of provider name -> tagged resource groups
         """
-        if len(instance_ids) <= 0:
-            logging.info("No instances IDs")
-            return
-        for ocid in instance_ids:
-            try:     
-                logging.info("Try to : {} - instance OCID: {}".format(action, ocid))
-                status = self.compute.instance_action(ocid, action).status
-                logging.info("Status : {} ".format(str(status)))
-                time.sleep(60/RPM_APICALL_LIMIT)
+        if names is None:
+            names = list(self.providers)
+        if len(names) <= 0:
+            return {}
+        #provider name -> tagged resources found by the search, the others crawl their compartments
+        found = {}
+        if DISCOVERY_BACKEND == 'search':
+            searchable = [name for name in names if self.providers[name].search_type is not None]
+            try:
+                found = self.search_tagged(searchable)
             except Exception as err:
-                logging.error("Unable to perform action: {} - instance OCID: {} - Error: {}".format(action, ocid, err))
+                logging.warning("Resource search failed in region {}, listing every compartment instead - Error: {}".format(self.region, err))
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            return dict(zip(names, pool.map(lambda name: self.providers[name].discover(found.get(name)), names)))
+
+    def search_tagged(self, names):
+        """
+        Find the resources of the given providers carrying every tag of TAG_KEYS in the region,
+        with one paginated structured search query, restricted to the known compartments
+        return a dictionary of provider name -> compact records
+        """
+        import oci
+        if len(names) <= 0:
+            return {}
+        types = {self.providers[name].search_type: name for name in names}
+        query = "query {} resources where {}".format(
+            ', '.join(sorted(types)), ' && '.join("freeformTags.key = '{}'".format(key) for key in sorted(TAG_KEYS)))
+        details = oci.resource_search.models.StructuredSearchDetails(type='Structured', query=query, matching_context_type='NONE')
+        compartments = set(self.compartment_ids)
+        found = {name: [] for name in names}
+        outside = 0
+        response = self.search.search_resources(details, limit=SEARCH_PAGE_SIZE)
+        while True:
+            for summary in response.data.items:
+                name = types.get(summary.resource_type.lower())
+                if name is None:
+                    continue
+                if summary.compartment_id not in compartments:
+                    outside += 1
+                    continue
+                found[name].append(ResourceRecord.from_search(summary))
+            if not response.has_next_page:
+                break
+            response = self.search.search_resources(details, limit=SEARCH_PAGE_SIZE, page=response.next_page)
+        logging.info("Resource search -- region: {}, {}, outside the scanned compartments: {}".format(
+            self.region, ', '.join('{}: {}'.format(name, len(records)) for name, records in found.items()), outside))
+        return found
 
-    #Database service methods
-    def get_all_dbsystems(self):
+    def resource_action(self, service, ocids, action, engine=None, journal=None, priorities=None):
         """
-        Return all dbsystems in a given compartment
+        Perform an action of a provider on a given list of OCID
+        if an engine is given actions are only queued on it, if a journal is given each call is recorded,
+        priorities = {OCID: priority} orders them, increasing to start and decreasing to stop
         """
-        if len(self.compartment_ids) <= 0:
+        if len(ocids) <= 0:
             return
+        run = engine is None
+        if run:
+            engine = ActionEngine()
+        priorities = priorities or {}
+        func = self.providers[service].action
+        if journal is not None:
+            func = journal.track(func)
+        #stops run in decreasing priority order, applications go down before their databases
+        order = 1 if action == self.providers[service].actions['start'] else -1
+        for ocid in ocids:
+            engine.submit(func, ocid, action, priority=order * priorities.get(ocid, DEFAULT_PRIORITY.get(service, 0)))
+        if run:
+            return engine.run('{}:{}'.format(service, action))
+
+    def group_by_tags(self, resources, service='compute'):
+        """
+        Bucket resources by their (Start, Stop, Weekend_stop) tags, as read by their provider, in a single pass
+        over any iterable, resources without every tag key are discarded and not kept
+        return a dictionary of tag values -> resources, in first seen order
+        """
+        groups = {}
+        added = 0
+        discarded = 0
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        for resource in resources:
+            try:
+                tags = self.providers[service].tags(resource)
+                key = tuple(tags[k] for k in TAG_KEY_ORDER)
+            except KeyError:
+                discarded += 1
+                if debug:
+                    logging.debug("{} descartada: {}".format(service, resource.display_name),
+                        extra={'region': self.region, 'service': service, 'ocid': resource.id})
+                continue
+            groups.setdefault(key, []).append(resource)
+            added += 1
+            if debug:
+                logging.debug("{} agregada: {}".format(service, resource.display_name),
+                    extra={'region': self.region, 'service': service, 'ocid': resource.id})
+
+        logging.info("Tag grouping {} -- region: {}, groups: {}, added: {}, discarded: {}".format(
+            service, self.region, len(groups), added, discarded))
+        return groups
 
-        for compartment_id in self.compartment_ids:   
-            response = self.database.list_db_systems(
-                compartment_id=compartment_id,
-                sort_by="TIMECREATED",
-                sort_order="ASC"
-            )
-            #list databse system with pagination
-            dbsys = response.data
-            while response.has_next_page:
-                response = self.database.list_db_systems(compartment_id, page=response.next_page)
-                dbsys.extend(response.data)  
-
-            #Store Database system ids
-            for dbs in dbsys:
-                if dbs.lifecycle_state == 'AVAILABLE':
-                    self.db_systems.append(dbs)    
-                         
-        return self.db_systems
-    
 
-    def get_db_nodes(self, compartment_id, db_system_id):
+
+PROVIDERS = {}
+
+def register_provider(provider):
+    """
+    Add a resource provider class to the registry, used as a class decorator
+    """
+    PROVIDERS[provider.name] = provider
+    return provider
+
+def entry_tables():
+    """
+    Return a dictionary of entries key -> (table, OCID list key) of the registered providers
+    """
+    return {provider.entries_key: (provider.table, provider.ocid_key) for provider in PROVIDERS.values()}
+
+
+class ResourceProvider:
+    """
+    A kind of resource ocicron schedules. A provider finds the tagged resources of a region,
+    reads their tags, lists the lifecycle states of a compartment and runs an action on one OCID
+    """
+
+    #registry name, also the key of SKIP_STATES, TARGET_STATES and DEFAULT_PRIORITY
+    name = None
+    #API service of its calls, the key of RATE_LIMITS
+    service = None
+    #entries key, OCID list key of an entry, and the ScheduleDB table of its resources
+    entries_key = None
+    ocid_key = None
+    table = None
+    #ocicron action -> API action
+    actions = {'start': 'START', 'stop': 'STOP'}
+    #lifecycle states of the resources worth scheduling
+    schedulable_states = ('RUNNING', 'STOPPED')
+    #resource type of the search service, None to always crawl the compartments
+    search_type = None
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def tags(self, resource):
+        return resource.freeform_tags
+
+    def list(self, compartment_id):
         """
-        Return DB Nodes in a given compartment and db system
+        Yield every resource of a compartment as a compact record
         """
-        response = self.database.list_db_nodes(
-            compartment_id=compartment_id,
-            db_system_id=db_system_id)        
-        return response.data
-    
-    def dbs_by_tags(self):   
+        raise NotImplementedError
+
+    def _list_all(self, list_func, compartment_id, **kwargs):
+        return (ResourceRecord(r) for r in iter_pages(list_func, compartment_id=compartment_id, **kwargs))
 
-        tags = self._discover_tags(service='database')
+    def discover(self, resources=None):
+        """
+        Return the tagged resources of the connection compartments grouped by tag values,
+        the resources found by a search can be given instead of listing the compartments
+        [{'tags': {...}, ocid_key: [OCID, ...], 'details': {OCID: (compartment, state, parent, priority, deadline)}}]
+        """
+        if resources is None:
+            resources = self.conn._stream_compartments(self.list)
+        resources = (r for r in resources if r.lifecycle_state in self.schedulable_states)
         result = []
-        for tag in tags:
-            db_group = {}
-            db_group["tags"] = tag
-            for db in self.filter_by_tags(tag, service='database'):
-                db_group["dbnodeOCID"] = [ node.id for node in self.get_db_nodes(db["compartment_id"], db["ocid"])]
-            result.append(db_group)
+        for key, group in self.conn.group_by_tags(resources, self.name).items():
+            result.append({
+                'tags': dict(zip(TAG_KEY_ORDER, key)),
+                self.ocid_key: [r.id for r in group],
+                'details': {r.id: (r.compartment_id, r.lifecycle_state, None, tag_priority(r, self.name), tag_deadline(r)) for r in group},
+            })
         return result
 
-    def database_action(self, db_node_ids, action):
+    def states(self, compartment_id, parent_ids):
         """
-        Perform action of a given list of db nodes OCID
+        Return a dictionary of OCID -> lifecycle state of the resources of a compartment,
+        parent_ids are the parents of the scheduled resources found in it
         """
-        if len(db_node_ids) <= 0:
-            return
-        for ocid in db_node_ids:
+        return {r.id: r.lifecycle_state for r in self.list(compartment_id)}
+
+    def action(self, ocid, action):
+        """
+        Run an API action on one resource, return True when it was accepted
+        """
+        raise NotImplementedError
+
+
+@register_provider
+class ComputeProvider(ResourceProvider):
+    name = 'compute'
+    service = 'compute'
+    entries_key = 'vms'
+    ocid_key = 'vmOCID'
+    table = 'vms'
+    actions = {'start': 'START', 'stop': 'SOFTSTOP'}
+    search_type = 'instance'
+
+    def list(self, compartment_id):
+        return self._list_all(self.conn.compute.list_instances, compartment_id, sort_by="TIMECREATED", sort_order="ASC")
+
+    def action(self, ocid, action):
+        fields = {'region': self.conn.region, 'service': self.name, 'ocid': ocid, 'action': action}
+        try:
+            status = self.conn.compute.instance_action(ocid, action).status
+            logging.debug("Action {} - instance OCID: {} - Status: {}".format(action, ocid, status), extra=fields)
+            return True
+        except Exception as err:
+            logging.error("Unable to perform action: {} - instance OCID: {} - Error: {}".format(action, ocid, err), extra=fields)
+            return False
+
+
+@register_provider
+class DatabaseProvider(ResourceProvider):
+    """
+    DB systems are tagged, their DB nodes are scheduled
+    """
+    name = 'database'
+    service = 'database'
+    entries_key = 'db_nodes'
+    ocid_key = 'dbnodeOCID'
+    table = 'db'
+    search_type = 'dbsystem'
+
+    #DB systems worth listing the nodes of
+    schedulable_states = ('AVAILABLE',)
+
+    def __init__(self, conn):
+        super().__init__(conn)
+        #cleared when the service requires a DB system to list DB nodes
+        self.compartment_node_listing = True
+
+    def list(self, compartment_id):
+        return self._list_all(self.conn.database.list_db_systems, compartment_id, sort_by="TIMECREATED", sort_order="ASC")
+
+    def _list_db_nodes(self, compartment_id, db_system_id=None):
+        kwargs = {} if db_system_id is None else {'db_system_id': db_system_id}
+        return [NodeRecord(node) for node in iter_pages(self.conn.database.list_db_nodes, compartment_id=compartment_id, **kwargs)]
+
+    def list_nodes(self, compartment_id, db_system_ids):
+        """
+        List the DB nodes of a compartment in one paginated listing, when the service
+        requires a DB system the nodes are listed per given DB system instead
+        """
+        if self.compartment_node_listing:
             try:
-                logging.info("Try to : {} - db_node OCID: {}".format(action, ocid))
-                self.database.db_node_action(ocid, action)
-                time.sleep(60/RPM_APICALL_LIMIT)
+                return self._list_db_nodes(compartment_id)
             except Exception as err:
-                logging.error("Unable to perform action: {} - database OCID: {} - Error: {}".format(action, ocid, err))
+                if getattr(err, 'status', None) != 400:
+                    raise
+                logging.info("DB nodes can't be listed per compartment, listing them per DB system - Error: {}".format(err))
+                self.compartment_node_listing = False
+        nodes = []
+        for db_system_id in db_system_ids:
+            nodes.extend(self._list_db_nodes(compartment_id, db_system_id))
+        return nodes
+
+    def nodes_by_system(self, db_systems):
+        """
+        List DB nodes once per compartment of the given DB systems, compartments in parallel,
+        return a dictionary of db_system_id -> nodes
+        """
+        systems = {}
+        for dbs in db_systems:
+            systems.setdefault(dbs.compartment_id, []).append(dbs.id)
+
+        #nodes of other DB systems of the compartments are dropped as they are listed
+        def tagged_nodes(compartment_id):
+            wanted = set(systems[compartment_id])
+            return (node for node in self.list_nodes(compartment_id, systems[compartment_id]) if node.db_system_id in wanted)
+
+        nodes = {}
+        for node in self.conn._stream_compartments(tagged_nodes, sorted(systems)):
+            nodes.setdefault(node.db_system_id, []).append(node)
+        return nodes
+
+    def discover(self, resources=None):
+        if resources is None:
+            resources = self.conn._stream_compartments(self.list)
+        resources = (r for r in resources if r.lifecycle_state in self.schedulable_states)
+        groups = self.conn.group_by_tags(resources, self.name)
+        #nodes of every tagged DB system, listed in bulk and joined in memory
+        nodes_by_system = self.nodes_by_system([db for dbs in groups.values() for db in dbs])
+
+        result = []
+        for key, dbs in groups.items():
+            db_group = {'tags': dict(zip(TAG_KEY_ORDER, key)), self.ocid_key: [], 'details': {}}
+            for db in dbs:
+                priority = tag_priority(db, self.name)
+                deadline = tag_deadline(db)
+                for node in nodes_by_system.get(db.id, []):
+                    db_group[self.ocid_key].append(node.id)
+                    #compartment, lifecycle state, DB system, priority and deadline of each OCID
+                    db_group['details'][node.id] = (db.compartment_id, node.lifecycle_state, db.id, priority, deadline)
+            result.append(db_group)
+        return result
+
+    def states(self, compartment_id, parent_ids):
+        db_system_ids = sorted(p for p in parent_ids if p)
+        return {node.id: node.lifecycle_state for node in self.list_nodes(compartment_id, db_system_ids)}
+
+    def action(self, ocid, action):
+        fields = {'region': self.conn.region, 'service': self.name, 'ocid': ocid, 'action': action}
+        try:
+            status = self.conn.database.db_node_action(ocid, action).status
+            logging.debug("Action {} - db_node OCID: {} - Status: {}".format(action, ocid, status), extra=fields)
+            return True
+        except Exception as err:
+            logging.error("Unable to perform action: {} - database OCID: {} - Error: {}".format(action, ocid, err), extra=fields)
+            return False
+
+
+@register_provider
+class InstancePoolProvider(ResourceProvider):
+    """
+    Tagged instance pools are started and stopped with one pool call for all their instances
+    """
+    name = 'instance_pool'
+    service = 'compute_management'
+    entries_key = 'instance_pools'
+    ocid_key = 'poolOCID'
+    table = 'instance_pools'
+    search_type = 'instancepool'
+
+    def list(self, compartment_id):
+        return self._list_all(self.conn.compute_management.list_instance_pools, compartment_id)
+
+    def action(self, ocid, action):
+        fields = {'region': self.conn.region, 'service': self.name, 'ocid': ocid, 'action': action}
+        try:
+            if action == 'START':
+                status = self.conn.compute_management.start_instance_pool(ocid).status
+            else:
+                status = self.conn.compute_management.stop_instance_pool(ocid).status
+            logging.debug("Action {} - instance pool OCID: {} - Status: {}".format(action, ocid, status), extra=fields)
+            return True
+        except Exception as err:
+            logging.error("Unable to perform action: {} - instance pool OCID: {} - Error: {}".format(action, ocid, err), extra=fields)
+            return False
+
+
+@register_provider
+class AutonomousDatabaseProvider(ResourceProvider):
+    name = 'autonomous_database'
+    service = 'database'
+    entries_key = 'autonomous_databases'
+    ocid_key = 'adbOCID'
+    table = 'autonomous_db'
+    schedulable_states = ('AVAILABLE', 'STOPPED')
+    search_type = 'autonomousdatabase'
+
+    def list(self, compartment_id):
+        return self._list_all(self.conn.database.list_autonomous_databases, compartment_id)
+
+    def action(self, ocid, action):
+        fields = {'region': self.conn.region, 'service': self.name, 'ocid': ocid, 'action': action}
+        try:
+            if action == 'START':
+                status = self.conn.database.start_autonomous_database(ocid).status
+            else:
+                status = self.conn.database.stop_autonomous_database(ocid).status
+            logging.debug("Action {} - autonomous database OCID: {} - Status: {}".format(action, ocid, status), extra=fields)
+            return True
+        except Exception as err:
+            logging.error("Unable to perform action: {} - autonomous database OCID: {} - Error: {}".format(action, ocid, err), extra=fields)
+            return False
+
 
 class ScheduleDB:
+    """
+    SQLite schedule store, one row per resource OCID
+
+    vms and db rows are indexed by (region, action hour, weekend flag) so a slot
+    lookup does not read the whole store. WAL mode lets cron fired executions
+    read while sync is writing.
+    """
+
+    #columns taken from the entry tags, a change means the resource was re-tagged
+    SCHEDULE_COLUMNS = ('region', 'start', 'stop', 'weekend_stop')
+    #columns taken from the entry details, refreshed on every sync
+    DETAIL_COLUMNS = ('compartment_id', 'lifecycle_state', 'parent_id', 'priority', 'deadline')
+
+    #one table per resource provider, see entry_tables
+    RESOURCE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS {0} (
+            ocid TEXT PRIMARY KEY,
+            region TEXT NOT NULL,
+            start TEXT NOT NULL,
+            stop TEXT NOT NULL,
+            weekend_stop TEXT NOT NULL,
+            compartment_id TEXT,
+            lifecycle_state TEXT,
+            parent_id TEXT,
+            priority INTEGER,
+            deadline INTEGER,
+            start_offset INTEGER,
+            stop_offset INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS {0}_start ON {0} (region, start, weekend_stop);
+        CREATE INDEX IF NOT EXISTS {0}_stop ON {0} (region, stop, weekend_stop);
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS compartments (
+            id TEXT PRIMARY KEY,
+            position INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS compartment_tree (
+            id TEXT PRIMARY KEY,
+            parent TEXT
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    #columns added after the first release of the SQLite store
+    ADDED_COLUMNS = {
+        'compartment_id': 'TEXT',
+        'lifecycle_state': 'TEXT',
+        'parent_id': 'TEXT',
+        'priority': 'INTEGER',
+        'deadline': 'INTEGER',
+        'start_offset': 'INTEGER',
+        'stop_offset': 'INTEGER',
+    }
 
     def __init__(self, location=os.path.join(DEFAULT_LOCATION, DB_FILE_NAME)):
         self.location = location
-        self.db = TinyDB(self.location)
-        self.vm_table = self.db.table('vms')
-        self.dbsys_table = self.db.table('db')
-        self.cid_table = self.db.table('compartments')
-        self.cron_table = self.db.table('cron')
+        self.lock = threading.RLock()
+        #autocommit, transactions are opened explicitly
+        self.conn = sqlite3.connect(self.location, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+        for table in self.tables():
+            self.conn.executescript(self.RESOURCE_SCHEMA.format(table))
+        self._add_columns()
+
+    def tables(self):
+        """
+        Return the resource tables of the registered providers
+        """
+        return [table for table, _ in entry_tables().values()]
+
+    def _add_columns(self):
+        for table in self.tables():
+            existing = {row[1] for row in self.conn.execute('PRAGMA table_info({})'.format(table))}
+            for column, column_type in self.ADDED_COLUMNS.items():
+                if column not in existing:
+                    self.conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, column_type))
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the block in a single write transaction
+        """
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def is_empty(self):
+        with self.lock:
+            for table in self.tables() + ['compartments']:
+                if self.conn.execute('SELECT 1 FROM {} LIMIT 1'.format(table)).fetchone() is not None:
+                    return False
+        return True
+
+    def _entry_rows(self, entries, key):
+        """
+        Return a dictionary of OCID -> (schedule values, detail values) of the entries of a table
+        """
+        _, ocid_key = entry_tables()[key]
+        empty = (None,) * len(self.DETAIL_COLUMNS)
+        rows = {}
+        for entry in entries.get(key, []):
+            schedule = (entry['region'], entry['Start'], entry['Stop'], entry['Weekend_stop'])
+            details = entry.get('details', {})
+            for ocid in entry[ocid_key]:
+                rows[ocid] = (schedule, (tuple(details.get(ocid, ())) + empty)[:len(empty)])
+        return rows
+
+    def _insert_sql(self, table, verb='INSERT'):
+        columns = ('ocid',) + self.SCHEDULE_COLUMNS + self.DETAIL_COLUMNS
+        return '{} INTO {} ({}) VALUES ({})'.format(verb, table, ', '.join(columns), ', '.join('?' * len(columns)))
+
+    def _insert_entries(self, conn, entries):
+        for key, (table, _) in entry_tables().items():
+            rows = [(ocid,) + schedule + details for ocid, (schedule, details) in self._entry_rows(entries, key).items()]
+            conn.executemany(self._insert_sql(table, 'INSERT OR REPLACE'), rows)
+
+    def insert_entries(self, entries):
+        """
+        Bulk insert the entries returned by generate_entries in one transaction
+        """
+        with self.transaction() as conn:
+            self._insert_entries(conn, entries)
+
+    def sync_entries(self, entries):
+        """
+        Apply the difference between fresh entries and the stored rows in one transaction,
+        only added, removed, re-tagged and updated (compartment or lifecycle state) resources are written
+        return a summary of changes per table
+        """
+        summary = {}
+        schedule_size = len(self.SCHEDULE_COLUMNS)
+        with self.transaction() as conn:
+            for key, (table, _) in entry_tables().items():
+                fresh = self._entry_rows(entries, key)
+                stored = {}
+                for row in conn.execute('SELECT ocid, {} FROM {}'.format(
+                        ', '.join(self.SCHEDULE_COLUMNS + self.DETAIL_COLUMNS), table)):
+                    stored[row[0]] = (tuple(row[1:1 + schedule_size]), tuple(row[1 + schedule_size:]))
+
+                added = [(ocid,) + schedule + details for ocid, (schedule, details) in fresh.items() if ocid not in stored]
+                removed = [(ocid,) for ocid in stored if ocid not in fresh]
+                retagged = []
+                updated = []
+                for ocid, (schedule, details) in fresh.items():
+                    if ocid not in stored:
+                        continue
+                    if stored[ocid][0] != schedule:
+                        retagged.append(schedule + details + (ocid,))
+                    elif stored[ocid][1] != details:
+                        updated.append(details + (ocid,))
+
+                if len(removed) > 0:
+                    conn.executemany('DELETE FROM {} WHERE ocid = ?'.format(table), removed)
+                if len(added) > 0:
+                    conn.executemany(self._insert_sql(table), added)
+                if len(retagged) > 0:
+                    conn.executemany('UPDATE {} SET {} WHERE ocid = ?'.format(
+                        table, ', '.join('{} = ?'.format(c) for c in self.SCHEDULE_COLUMNS + self.DETAIL_COLUMNS)), retagged)
+                if len(updated) > 0:
+                    conn.executemany('UPDATE {} SET {} WHERE ocid = ?'.format(
+                        table, ', '.join('{} = ?'.format(c) for c in self.DETAIL_COLUMNS)), updated)
+                summary[table] = {'added': len(added), 'removed': len(removed), 'retagged': len(retagged), 'updated': len(updated)}
+        return summary
+
+    def update_states(self, table, states):
+        """
+        Store the lifecycle states resources settle in after a slot, states = {OCID: lifecycle state}
+        """
+        if len(states) <= 0:
+            return
+        with self.transaction() as conn:
+            conn.executemany('UPDATE {} SET lifecycle_state = ? WHERE ocid = ?'.format(table),
+                [(state, ocid) for ocid, state in states.items()])
+
+    def find_resources(self, table, region, action, hour, weekend_stop, offset=None):
+        """
+        Return OCID, compartment, last known lifecycle state, parent, priority and deadline
+        of the resources of a table matching a given slot, by priority.
+        With an offset only the resources planned for the wave firing that many minutes after the slot
+        """
+        column = 'stop' if action == 'stop' else 'start'
+        query = 'SELECT ocid, compartment_id, lifecycle_state, parent_id, priority, deadline FROM {} WHERE region = ? AND {} = ? AND weekend_stop = ?'.format(table, column)
+        params = (region, hour, weekend_stop.capitalize())
+        if offset is not None:
+            query += ' AND COALESCE({}_offset, 0) = ?'.format(column)
+            params += (offset,)
+        with self.lock:
+            rows = self.conn.execute(query + ' ORDER BY priority', params).fetchall()
+        return [{'ocid': row[0], 'compartment_id': row[1], 'lifecycle_state': row[2], 'parent_id': row[3], 'priority': row[4], 'deadline': row[5]} for row in rows]
+
+    def slot_loads(self):
+        """
+        Return the number of resources and the tightest deadline of every slot of each table
+        as a list of (table, region, action, hour, weekend_stop, resources, deadline)
+        """
+        loads = []
+        with self.lock:
+            for table in self.tables():
+                for action in ('start', 'stop'):
+                    for row in self.conn.execute(
+                            'SELECT region, {0}, weekend_stop, COUNT(*), MIN(deadline) FROM {1} GROUP BY region, {0}, weekend_stop'.format(action, table)):
+                        loads.append((table, row[0], action, row[1], row[2], row[3], row[4]))
+        return loads
+
+    def slot_waves(self):
+        """
+        Return the planned wave offsets (minutes after the slot time) of every slot,
+        as a dictionary of (region, action, hour, weekend_stop) -> sorted offsets
+        """
+        waves = {}
+        with self.lock:
+            for table in self.tables():
+                for action in ('start', 'stop'):
+                    for row in self.conn.execute(
+                            'SELECT DISTINCT region, {0}, weekend_stop, COALESCE({0}_offset, 0) FROM {1}'.format(action, table)):
+                        waves.setdefault((row[0], action, row[1], row[2].lower()), set()).add(row[3])
+        return {slot: sorted(offsets) for slot, offsets in waves.items()}
+
+    def slot_resources(self):
+        """
+        Return every stored resource with its slots, compartment, priority, deadline and planned offsets
+        """
+        columns = ('ocid', 'region', 'start', 'stop', 'weekend_stop', 'compartment_id', 'priority', 'deadline', 'start_offset', 'stop_offset')
+        resources = []
+        with self.lock:
+            for table in self.tables():
+                for row in self.conn.execute('SELECT {} FROM {}'.format(', '.join(columns), table)):
+                    resource = dict(zip(columns, row))
+                    resource['table'] = table
+                    resources.append(resource)
+        return resources
+
+    def set_offsets(self, offsets):
+        """
+        Store the planned wave offsets, offsets = {table: [(start offset, stop offset, OCID)]}
+        """
+        if not any(offsets.values()):
+            return
+        with self.transaction() as conn:
+            for table, rows in offsets.items():
+                conn.executemany('UPDATE {} SET start_offset = ?, stop_offset = ? WHERE ocid = ?'.format(table), rows)
+
+    def regions(self):
+        """
+        Return the regions with scheduled resources
+        """
+        with self.lock:
+            rows = self.conn.execute(' UNION '.join('SELECT DISTINCT region FROM {}'.format(table) for table in self.tables())).fetchall()
+        return sorted(r[0] for r in rows)
+
+    def data_version(self):
+        """
+        Changes every time another connection commits to the database
+        """
+        with self.lock:
+            return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def get_compartments(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT id FROM compartments ORDER BY position').fetchall()
+        return [row[0] for row in rows]
+
+    def set_compartments(self, compartment_ids):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM compartments')
+            conn.executemany('INSERT INTO compartments (id, position) VALUES (?, ?)',
+                [(cid, position) for position, cid in enumerate(compartment_ids)])
+
+    def load_compartment_tree(self, ttl):
+        """
+        Return the cached compartment tree, or None when missing or older than ttl seconds
+        """
+        with self.lock:
+            fetched_at = self.conn.execute("SELECT value FROM meta WHERE key = 'compartment_tree_fetched_at'").fetchone()
+            if fetched_at is None or time.time() - float(fetched_at[0]) > ttl:
+                return None
+            return dict(self.conn.execute('SELECT id, parent FROM compartment_tree ORDER BY rowid').fetchall())
+
+    def save_compartment_tree(self, tree):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM compartment_tree')
+            conn.executemany('INSERT INTO compartment_tree (id, parent) VALUES (?, ?)', list(tree.items()))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('compartment_tree_fetched_at', ?)", (str(time.time()),))
+
+    def migrate_json(self, json_location=os.path.join(DEFAULT_LOCATION, JSON_DB_FILE_NAME)):
+        """
+        One shot import of a TinyDB scheduleDB.json file into the SQLite store
+        """
+        with open(json_location) as f:
+            data = json.load(f)
+
+        entries = {
+            'vms': list(data.get('vms', {}).values()),
+            'db_nodes': list(data.get('db', {}).values()),
+        }
+        compartments = [doc['compartments'] for doc in data.get('compartments', {}).values()]
+        with self.transaction() as conn:
+            self._insert_entries(conn, entries)
+            if len(compartments) > 0:
+                conn.execute('DELETE FROM compartments')
+                conn.executemany('INSERT INTO compartments (id, position) VALUES (?, ?)',
+                    [(cid, position) for position, cid in enumerate(compartments[0])])
+        logging.info("Migrated {} -- vm groups: {}, db groups: {}".format(json_location, len(entries['vms']), len(entries['db_nodes'])))
+        return entries
+
+
+def partition_of(region, compartment_id, partitions=1):
+    """
+    Partition of a resource: its region and a bucket of its compartment, stable across hosts and runs
+    """
+    bucket = zlib.crc32((compartment_id or '').encode()) % partitions if partitions > 1 else 0
+    return '{}/{}'.format(region, bucket)
+
+def region_partitions(region, partitions=1):
+    return ['{}/{}'.format(region, bucket) for bucket in range(partitions)]
+
+
+class LeaseStore:
+    """
+    Partition leases of the controller hosts, in a SQLite file every controller can open.
+    Each claim renews the leases of a controller and takes free or expired partitions up to its
+    fair share, the partitions divided by the controllers seen within the lease time.
+    Only a rebalancing claim, made between slots, releases the leases above the share so
+    controllers that joined can take them. A claim made when a slot fires keeps every lease held,
+    otherwise the partitions it released would be left to nobody until the others claim again
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS leases (
+            partition TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS controllers (
+            owner TEXT PRIMARY KEY,
+            seen REAL NOT NULL
+        );
+    """
+
+    def __init__(self, location, owner, ttl):
+        self.location = location
+        self.owner = owner
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        #default rollback journal, WAL needs shared memory the hosts of a shared mount don't have
+        self.conn = sqlite3.connect(self.location, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.executescript(self.SCHEMA)
 
-        #Query
-        self.query = Query()
+    @contextmanager
+    def transaction(self):
+        """
+        Run the block in a single write transaction
+        """
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def claim(self, partitions, now=None, rebalance=False):
+        """
+        Renew the leases of this controller and take its share of the given partitions,
+        with rebalance its leases above the share are released
+        return the sorted partitions it owns
+        """
+        now = time.time() if now is None else now
+        partitions = sorted(set(partitions))
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO controllers (owner, seen) VALUES (?, ?)', (self.owner, now))
+            live = conn.execute('SELECT COUNT(*) FROM controllers WHERE seen > ?', (now - self.ttl,)).fetchone()[0]
+            share = -(-len(partitions) // max(1, live))
+            leases = {row[0]: (row[1], row[2]) for row in conn.execute('SELECT partition, owner, expires FROM leases')}
 
+            mine = [p for p in partitions if p in leases and leases[p][0] == self.owner]
+            free = [p for p in partitions if p not in leases or (leases[p][0] != self.owner and leases[p][1] <= now)]
+            owned, released = (mine[:share], mine[share:]) if rebalance else (mine, [])
+            taken = free[:max(0, share - len(owned))]
 
-    def flush(self):
-        return self.db.drop_table('vms') and self.db.drop_table('db')
+            if len(released) > 0:
+                conn.executemany('DELETE FROM leases WHERE partition = ? AND owner = ?', [(p, self.owner) for p in released])
+            conn.executemany('INSERT OR REPLACE INTO leases (partition, owner, expires) VALUES (?, ?, ?)',
+                [(p, self.owner, now + self.ttl) for p in owned + taken])
+
+        for p in taken:
+            if p in leases:
+                logging.warning("Lease of partition {} taken over from controller {}, expired {:.0f}s ago".format(p, leases[p][0], now - leases[p][1]))
+        if len(released) > 0:
+            logging.info("Leases released for other controllers -- partitions: {}".format(', '.join(released)))
+        return sorted(owned + taken)
+
+    def release(self):
+        """
+        Give up every lease of this controller, others take its partitions on their next claim
+        """
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM leases WHERE owner = ?', (self.owner,))
+            conn.execute('DELETE FROM controllers WHERE owner = ?', (self.owner,))
+
+    def leases(self):
+        """
+        Return every lease as a dictionary of partition -> (owner, expiry time)
+        """
+        with self.lock:
+            return {row[0]: (row[1], row[2]) for row in self.conn.execute('SELECT partition, owner, expires FROM leases ORDER BY partition')}
+
+
+def slot_minute(hour):
+    """
+    Minute of the day of a Start or Stop tag, a whole hour 'HH' or 'HH:MM'
+    """
+    hours, _, minutes = str(hour).partition(':')
+    minute = int(hours) * 60 + int(minutes or 0)
+    if not 0 <= int(hours) < 24 or not 0 <= int(minutes or 0) < 60:
+        raise ValueError("invalid time {}".format(hour))
+    return minute
+
+
+class SlotWheel:
+    """
+    Timer wheel of slots with one bucket per minute of the day,
+    slots fire on the same days as the jobs from Schedule.cron_generator.
+    A slot split by the load planner fires once per wave, with the wave offset
+    as fifth element, None when the slot runs whole
+    """
+
+    def __init__(self, waves):
+        self.buckets = {}
+        for (region, action, hour, weekend_stop), offsets in waves.items():
+            try:
+                minute = slot_minute(hour)
+            except ValueError:
+                logging.warning("Invalid hour {} for {} action in region {}".format(hour, action, region))
+                continue
+            if offsets == [0]:
+                self.buckets.setdefault(minute, set()).add((region, action, hour, weekend_stop, None))
+                continue
+            for offset in offsets:
+                self.buckets.setdefault(minute + offset, set()).add((region, action, hour, weekend_stop, offset))
+
+    def __len__(self):
+        return sum(len(slots) for slots in self.buckets.values())
+
+    def due(self, when):
+        """
+        Return the slots firing at a given datetime, weekend_stop slots only fire Monday to Friday
+        """
+        slots = self.buckets.get(when.hour * 60 + when.minute, set())
+        weekday = when.weekday() < 5
+        return sorted(slot for slot in slots if slot[3] != 'yes' or weekday)
+
+
+class LoadPlanner:
+    """
+    Per-minute histogram of the API calls predicted for the slots of the schedule store,
+    and a plan spreading the actions of crowded minutes over the minutes that follow.
+
+    Every action is one call to the service of its provider, plus one state listing per
+    compartment, provider and wave. The budget of a minute is a fraction of the rate limit
+    of the region and service. Slots are placed in time order and their resources by priority,
+    each in the first minute of its window with budget left, so a slot is shifted whole when its
+    minute is taken and split in waves when it doesn't fit. A resource is not moved past its
+    deadline nor past midnight. Weekend stop slots fire on weekdays like the others,
+    so a single weekday histogram is planned.
+    """
+
+    def __init__(self, window=0, fraction=1.0):
+        self.window = window
+        self.fraction = fraction
+        #(region, service) -> calls per minute of the day when every slot fires at its tagged time
+        self.before = {}
+        #(region, service) -> calls per minute of the day of the plan
+        self.after = {}
+        #(region, action, hour, weekend_stop) -> {offset: resources}
+        self.waves = {}
+        #(table, OCID) -> {action: offset} planned and stored
+        self.offsets = {}
+        self.stored = {}
+
+    def budget(self, region, service):
+        return rate_limit(region, service)[0] * 60 * self.fraction
+
+    def plan(self, resources):
+        """
+        Plan the resources returned by ScheduleDB.slot_resources
+        """
+        slots = {}
+        for r in resources:
+            self.stored[(r['table'], r['ocid'])] = {'start': r['start_offset'] or 0, 'stop': r['stop_offset'] or 0}
+            for action in ('start', 'stop'):
+                try:
+                    minute = slot_minute(r[action])
+                except ValueError:
+                    continue
+                slots.setdefault((r['region'], action, r[action], r['weekend_stop'].lower()), (minute, []))[1].append(r)
+        self.before, _, _ = self._place(slots, 0)
+        self.after, self.offsets, self.waves = self._place(slots, self.window)
+        return self
+
+    def _place(self, slots, window):
+        services = {provider.table: provider.service for provider in PROVIDERS.values()}
+        calls = {}
+        offsets = {}
+        waves = {}
+        #(region, table, compartment, minute) listed once per wave
+        listed = set()
+        for slot, (minute, resources) in sorted(slots.items(), key=lambda item: (item[1][0], item[0])):
+            region, action = slot[0], slot[1]
+            counts = waves.setdefault(slot, {})
+            for r in sorted(resources, key=lambda r: (r['priority'] is None, r['priority'] or 0, r['ocid'])):
+                service = services[r['table']]
+                load = calls.setdefault((region, service), [0] * 24 * 60)
+                budget = self.budget(region, service)
+                span = window if r['deadline'] is None else min(window, r['deadline'])
+                minutes = range(minute, min(minute + max(span, 1), 24 * 60))
+                cost = {m: 1 + ((region, r['table'], r['compartment_id'], m) not in listed) for m in minutes}
+                chosen = next((m for m in minutes if load[m] + cost[m] <= budget), None)
+                if chosen is None:
+                    chosen = min(minutes, key=lambda m: load[m] + cost[m])
+                load[chosen] += cost[chosen]
+                listed.add((region, r['table'], r['compartment_id'], chosen))
+                offsets.setdefault((r['table'], r['ocid']), {})[action] = chosen - minute
+                counts[chosen - minute] = counts.get(chosen - minute, 0) + 1
+        return calls, offsets, waves
+
+    def changes(self):
+        """
+        Return the planned offsets that differ from the stored ones, as expected by ScheduleDB.set_offsets
+        """
+        changes = {}
+        for (table, ocid), stored in self.stored.items():
+            planned = self.offsets.get((table, ocid), {})
+            start, stop = planned.get('start', 0), planned.get('stop', 0)
+            if (start, stop) != (stored['start'], stored['stop']):
+                changes.setdefault(table, []).append((start, stop, ocid))
+        return changes
+
+    @staticmethod
+    def peak(calls):
+        """
+        Return the highest calls of a histogram and its minute of the day
+        """
+        minute = max(range(len(calls)), key=lambda m: calls[m])
+        return calls[minute], minute
+
+    def over_budget(self):
+        """
+        Return the (region, service, minute, calls) of the planned minutes above their budget
+        """
+        return [(region, service, minute, calls) for (region, service), load in sorted(self.after.items())
+            for minute, calls in enumerate(load) if calls > self.budget(region, service)]
+
+    def report(self, width=40):
+        """
+        Return the lines of the plan: peak calls per region and service before and after smoothing,
+        the histogram of the busy minutes and the slots shifted or split in waves
+        """
+        lines = ['{:<24} {:<20} {:>10} {:>16} {:>16}'.format('Region', 'Service', 'Budget/min', 'Peak before', 'Peak planned')]
+        for key in sorted(self.after):
+            before, after = self.peak(self.before[key]), self.peak(self.after[key])
+            lines.append('{:<24} {:<20} {:>10.0f} {:>16} {:>16}'.format(key[0], key[1], self.budget(*key),
+                '{} at {:02d}:{:02d}'.format(before[0], *divmod(before[1], 60)),
+                '{} at {:02d}:{:02d}'.format(after[0], *divmod(after[1], 60))))
+        for key in sorted(self.after):
+            lines.append('')
+            lines.append('{} {} -- calls per minute, before -> planned'.format(*key))
+            scale = max(max(self.before[key]), 1)
+            for minute, (before, after) in enumerate(zip(self.before[key], self.after[key])):
+                if before or after:
+                    lines.append('  {:02d}:{:02d} {:>7} -> {:<7} {}'.format(minute // 60, minute % 60, before, after,
+                        '#' * int(round(width * after / scale))))
+        moved = [(slot, counts) for slot, counts in sorted(self.waves.items()) if list(counts) != [0]]
+        if len(moved) > 0:
+            lines.append('')
+            lines.append('Slots shifted or split -- offset in minutes: resources')
+            for slot, counts in moved:
+                lines.append('  {:<40} {}'.format(':'.join(slot), ', '.join('+{}: {}'.format(offset, count)
+                    for offset, count in sorted(counts.items()))))
+        return lines
 
 
 class Schedule:
 
     def __init__(self, tabfile=None):
+        from crontab import CronTab
+        self.tabfile = tabfile
         if tabfile is not None:
-            self.tabfile = tabfile
             self.cron = CronTab(user=True, tabfile=self.tabfile)
         else:
             self.cron = CronTab(user=True)
+        #staged changes are written once when the outermost batch ends
+        self.batching = 0
+        self.dirty = False
+        #ocicron jobs indexed by command, built on first use
+        self._jobs = None
+
+    @property
+    def jobs_by_command(self):
+        if self._jobs is None:
+            self._jobs = {}
+            for job in self.cron.find_command(command='ocicron.py'):
+                self._jobs.setdefault(job.command, []).append(job)
+        return self._jobs
+
+    def _write(self):
+        if self.batching:
+            self.dirty = True
+            return
+        if self.tabfile is not None:
+            #replace the file in one step so readers never see a partial crontab
+            tmp = '{}.tmp'.format(self.tabfile)
+            with open(tmp, 'w') as f:
+                f.write(self.cron.render())
+            os.replace(tmp, self.tabfile)
+        else:
+            #the crontab program installs the whole file at once
+            self.cron.write()
+
+    @contextmanager
+    def batch(self):
+        """
+        Stage adds and removes and commit them with a single crontab write,
+        staged changes are discarded if the block fails
+        """
+        self.batching += 1
+        try:
+            yield self
+        except Exception:
+            self.batching -= 1
+            if not self.batching:
+                self.dirty = False
+                self.cron.read(self.tabfile)
+                self._jobs = None
+            raise
+        self.batching -= 1
+        if not self.batching and self.dirty:
+            self.dirty = False
+            self._write()
     
     def new(self, command, schedule, comment=None):
         job = self.cron.new(command=command, comment=comment)
         
         job.setall(schedule)
-        self.cron.write()
+        if 'ocicron.py' in command:
+            self.jobs_by_command.setdefault(command, []).append(job)
+        self._write()
     
     @staticmethod
-    def cron_generator(hour, weekend, region, action):
+    def cron_generator(hour, weekend, region, action, offset=None):
         """
         EJ: 0 20 * * * python ocicron.py --region us-ashburn-1 --action stop --at 09 --weekend-stop yes
         r['Stop'], False, region, 'stop'
+        hour is 'HH' or 'HH:MM', a wave of a split slot fires offset minutes later and runs with --offset
         """
+        hours, minutes = divmod(slot_minute(hour) + (offset or 0), 60)
+        command = 'cd {} && ./ocicron.py --region {} --action {} --at {} --weekend-stop {}'.format(DEFAULT_LOCATION, region, action, hour, weekend)
+        if offset is not None:
+            command += ' --offset {}'.format(offset)
         #if weekend is True means should remains stopped all weekend
         if weekend == 'yes':
-            return '0 {} * * 1-5'.format(hour), 'cd {} && ./ocicron.py --region {} --action {} --at {} --weekend-stop {}'.format(DEFAULT_LOCATION, region, action, hour, weekend)
+            return '{} {:02d} * * 1-5'.format(minutes, hours), command
         else:
-            return '0 {} * * *'.format(hour), 'cd {} && ./ocicron.py --region {} --action {} --at {} --weekend-stop {}'.format(DEFAULT_LOCATION, region, action, hour, weekend)
+            return '{} {:02d} * * *'.format(minutes, hours), command
     
+    @staticmethod
+    def dispatch_generator(minute):
+        """
+        EJ: 0 20 * * * python ocicron.py dispatch --at 20
+        one job per firing minute of the day, the dispatcher picks the slots of every region and applies the weekend rule
+        """
+        hours, minutes = divmod(minute, 60)
+        at = '{:02d}'.format(hours) if minutes == 0 else '{:02d}:{:02d}'.format(hours, minutes)
+        return '{} {} * * *'.format(minutes, hours), 'cd {} && ./ocicron.py dispatch --at {}'.format(DEFAULT_LOCATION, at)
+
     def is_schedule(self, command):
         """
         Find if a given schedule exists in crontab file
         """
-        cron_commands = []
-        for job in self.cron.find_command(command='ocicron.py'):
-            cron_commands.append(job.command)
-        
-        if command in cron_commands:
-            return True
-        return False
+        return command in self.jobs_by_command
+
+    def jobs(self, command):
+        """
+        Return a dictionary of command -> schedule of the jobs matching a given command
+        """
+        return {c: str(jobs[0].slices) for c, jobs in self.jobs_by_command.items() if command in c}
 
-    def clean_jobs(self, command):
+    def remove(self, command):
         """
-        Find commands in crontab and remove them
+        Remove the jobs with exactly the given command
         """
-        self.cron.remove_all(command=command)
-        self.cron.write()
+        jobs = self.jobs_by_command.pop(command, [])
+        if len(jobs) > 0:
+            self.cron.remove(*jobs)
+            self._write()
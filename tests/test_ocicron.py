@@ -0,0 +1,480 @@
+import os
+import json
+import time
+import base64
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import ocicron
+import ocicron_service
+from ocicron_fake import FakeTenancy
+from ocicron_service import OCI, LeaseStore, ScheduleDB, Schedule, ExecutionJournal, TokenCache, instance_principals_signer
+
+
+PARTITIONS = ['r{}/0'.format(i) for i in range(1, 5)]
+
+
+def vm_entries(*vms):
+    """
+    Entries as returned by generate_entries, vms = (OCID, Start, Stop, Weekend_stop, lifecycle state)
+    """
+    return {'vms': [{'region': 'r1', 'Start': start, 'Stop': stop, 'Weekend_stop': weekend, 'vmOCID': [ocid],
+        'details': {ocid: ('c1', state, None, 20, None)}} for ocid, start, stop, weekend, state in vms]}
+
+
+@pytest.fixture
+def controller(tmp_path, monkeypatch):
+    """
+    ocicron with its schedule store and crontab in a temporary directory
+    """
+    tabfile = tmp_path / 'crontab'
+    tabfile.write_text('')
+    monkeypatch.setattr(ocicron, 'db', ScheduleDB(str(tmp_path / 'scheduleDB.sqlite')))
+    monkeypatch.setattr(ocicron, 'cron', Schedule(tabfile=str(tabfile)))
+    monkeypatch.setattr(ocicron, 'SCHEDULER_MODE', 'cron')
+    monkeypatch.setattr(ocicron, 'LEASE_DB', None)
+    return ocicron
+
+
+@pytest.fixture
+def fake(controller, tmp_path, monkeypatch):
+    """
+    ocicron connected to a synthetic tenancy, with rate limits high enough to never wait
+    """
+    monkeypatch.setattr(ocicron_service, 'RATE_LIMITS', {service: (1000, 1000) for service in ocicron_service.RATE_LIMITS})
+    monkeypatch.setattr(ocicron_service, 'DEFAULT_RATE_LIMIT', (1000, 1000))
+    monkeypatch.setattr(ocicron_service, 'RATE_LIMIT_DIR', None)
+    monkeypatch.setattr(ocicron_service, '_limiters', {})
+    monkeypatch.setattr(ocicron_service, 'JOURNAL_DIR', str(tmp_path / 'journal'))
+    monkeypatch.setattr(controller, 'CLIENTS', FakeTenancy(compartments=3, instances=10, db_systems=1, tagged=1.0, slots=1))
+    return controller
+
+
+def discover(controller):
+    """
+    Entries of every tagged resource of the tenancy, as init and sync build them
+    """
+    conn = controller.connect()
+    conn.get_suscribed_regions()
+    controller.db.set_compartments(controller.discover_compartments(conn, [], refresh=True))
+    return controller.generate_entries(conn.suscribed_regions)
+
+
+def crontab_commands(controller):
+    return set(Schedule(tabfile=controller.cron.tabfile).jobs('ocicron.py'))
+
+
+def test_lease_handover_to_joining_controller(tmp_path):
+    location = str(tmp_path / 'leases.sqlite')
+    first = LeaseStore(location, 'first', 900)
+    second = LeaseStore(location, 'second', 900)
+    assert first.claim(PARTITIONS, now=0) == PARTITIONS
+
+    #the second controller joins as a slot fires, claiming before the first one
+    joined = second.claim(PARTITIONS, now=10)
+    kept = first.claim(PARTITIONS, now=11)
+    assert joined == []
+    assert kept == PARTITIONS
+
+    #between slots the renewal hands the partitions above the share over
+    renewed = first.claim(PARTITIONS, now=60, rebalance=True)
+    assert len(renewed) == 2
+    for now, controller in ((120, first), (121, second)):
+        controller.claim(PARTITIONS, now=now)
+    owners = {partition: owner for partition, (owner, _) in first.leases().items()}
+    assert sorted(owners) == PARTITIONS
+    assert sorted(owners.values()) == ['first', 'first', 'second', 'second']
+
+
+def test_slot_claim_never_leaves_partitions_out(tmp_path):
+    location = str(tmp_path / 'leases.sqlite')
+    first = LeaseStore(location, 'first', 900)
+    second = LeaseStore(location, 'second', 900)
+    first.claim(PARTITIONS, now=0)
+    second.claim(PARTITIONS, now=1)
+    #the first controller releases above its share, a slot fires before the second renews
+    first.claim(PARTITIONS, now=60, rebalance=True)
+    owned = set(first.claim(PARTITIONS, now=61)) | set(second.claim(PARTITIONS, now=62))
+    assert owned == set(PARTITIONS)
+
+
+def test_expired_leases_are_taken_over(tmp_path):
+    location = str(tmp_path / 'leases.sqlite')
+    first = LeaseStore(location, 'first', 900)
+    second = LeaseStore(location, 'second', 900)
+    first.claim(PARTITIONS, now=0)
+    assert second.claim(PARTITIONS, now=1000) == PARTITIONS
+
+
+def test_sync_commands_follows_scheduler_mode(controller):
+    controller.db.insert_entries(vm_entries(('vm1', '08', '20', 'No', 'RUNNING')))
+    controller.sync_commands()
+    slots = crontab_commands(controller)
+    assert len(slots) == 2
+    assert all('--region r1' in command for command in slots)
+
+    controller.SCHEDULER_MODE = 'daemon'
+    controller.sync_commands()
+    assert crontab_commands(controller) == {controller.DEFAULT_DAEMON_COMMAND}
+
+    controller.SCHEDULER_MODE = 'dispatch'
+    controller.sync_commands()
+    commands = crontab_commands(controller)
+    assert controller.DEFAULT_DAEMON_COMMAND not in commands
+    assert {command.split()[-1] for command in commands} == {'08', '20'}
+
+    controller.SCHEDULER_MODE = 'cron'
+    controller.sync_commands()
+    assert crontab_commands(controller) == slots
+
+
+def test_lease_renewal_job_only_outside_daemon_mode(controller, tmp_path):
+    controller.db.insert_entries(vm_entries(('vm1', '08', '20', 'No', 'RUNNING')))
+    controller.LEASE_DB = str(tmp_path / 'leases.sqlite')
+    controller.sync_commands()
+    assert controller.DEFAULT_LEASE_COMMAND in crontab_commands(controller)
+
+    controller.SCHEDULER_MODE = 'daemon'
+    controller.sync_commands()
+    assert crontab_commands(controller) == {controller.DEFAULT_DAEMON_COMMAND}
+
+
+def stub_certificate(tenancy_id):
+    """
+    Self signed certificate and its key in PEM, carrying the tenancy like instance certificates do
+    """
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'ocid1.instance.oc1..stub'),
+        x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, 'opc-tenant:{}'.format(tenancy_id))])
+    now = datetime.datetime.utcnow()
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+        .serial_number(1).not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256()))
+    return (certificate.public_bytes(serialization.Encoding.PEM),
+        key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
+
+
+def stub_token(expires):
+    encode = lambda data: base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+    return '{}.{}.c2ln'.format(encode({'alg': 'RS256'}), encode({'exp': expires, 'sub': 'ocid1.instance.oc1..stub'}))
+
+
+@pytest.fixture
+def metadata_stub():
+    """
+    Local stand-in of the instance metadata service and of the federation endpoint
+    """
+    certificate, key = stub_certificate('ocid1.tenancy.oc1..stub')
+    token = stub_token(int(time.time()) + 3600)
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, body, content_type='text/plain'):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            requests.append(self.path)
+            body = {'/opc/v2/instance/region': b'us-ashburn-1', '/opc/v2/identity/cert.pem': certificate,
+                '/opc/v2/identity/key.pem': key, '/opc/v2/identity/intermediate.pem': certificate}.get(self.path)
+            if body is None:
+                self.send_error(404)
+            else:
+                self._send(body)
+
+        def do_POST(self):
+            requests.append(self.path)
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self._send(json.dumps({'token': token}).encode(), 'application/json')
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_port), token, requests
+    server.shutdown()
+
+
+def test_signer_uses_local_metadata_service(metadata_stub, tmp_path, monkeypatch):
+    base, token, requests = metadata_stub
+    monkeypatch.delenv('OCI_METADATA_BASE_URL', raising=False)
+    cache = TokenCache(str(tmp_path / 'token'),
+        signer_factory=lambda: instance_principals_signer(base + '/opc/v2', base + '/v1/x509'))
+    entry = cache.entry()
+    assert entry['token'] == token
+    assert entry['tenancy_id'] == 'ocid1.tenancy.oc1..stub'
+    assert entry['region'] == 'us-ashburn-1'
+    assert '/opc/v2/identity/cert.pem' in requests and '/v1/x509' in requests
+    #the endpoint only applies to the signer, not to the rest of the process
+    assert 'OCI_METADATA_BASE_URL' not in os.environ
+
+
+def polled_connection(stopped_after):
+    """
+    Connection whose listed instances are STOPPED once stopped_after seconds have passed, counting the listings
+    """
+    conn = OCI.__new__(OCI)
+    started = time.monotonic()
+    conn.checks = 0
+    def lifecycle_states(resources, service):
+        conn.checks += 1
+        state = 'STOPPED' if time.monotonic() - started >= stopped_after else 'STOPPING'
+        return {r['ocid']: state for r in resources}
+    conn.lifecycle_states = lifecycle_states
+    return conn
+
+
+def test_wait_reads_poll_interval_at_call_time(monkeypatch):
+    monkeypatch.setattr(ocicron_service, 'WAIT_POLL_SECONDS', 0.05)
+    conn = polled_connection(0.2)
+    reached, stragglers = conn.wait_for_states([([{'ocid': 'vm1'}], 'SOFTSTOP', 'compute')], 5)
+    assert stragglers == {}
+    assert 0.2 <= reached['vm1'] < 0.5
+
+
+def test_wait_shorter_than_poll_checks_again_at_deadline():
+    conn = polled_connection(0.3)
+    started = time.monotonic()
+    reached, stragglers = conn.wait_for_states([([{'ocid': 'vm1'}, {'ocid': 'vm2'}], 'SOFTSTOP', 'compute')], 0.5, poll=15)
+    assert time.monotonic() - started < 2
+    assert conn.checks == 2
+    assert set(reached) == {'vm1', 'vm2'} and stragglers == {}
+
+
+def test_journal_resume_and_retry(tmp_path):
+    journal = ExecutionJournal.for_slot('r1:start:08:no', location=str(tmp_path))
+    for ocid, outcome in (('vm1', 'accepted'), ('vm2', 'failed')):
+        journal.record(ocid, 'issued', 'START')
+        journal.record(ocid, outcome, 'START')
+    journal.record('vm3', 'issued', 'START')
+    journal.close()
+    #a crash while writing leaves a torn last line
+    with open(journal.path, 'a') as handle:
+        handle.write('{"ocid": "vm4", "sta')
+
+    resources = [{'ocid': ocid} for ocid in ('vm1', 'vm2', 'vm3', 'vm4')]
+    resumed = ExecutionJournal.for_slot('r1:start:08:no', 'resume', location=str(tmp_path))
+    assert resumed.path == journal.path
+    assert [r['ocid'] for r in resumed.remaining(resources, 'resume')] == ['vm2', 'vm3', 'vm4']
+    assert [r['ocid'] for r in resumed.remaining(resources, 'retry')] == ['vm2']
+    resumed.record('vm2', 'accepted', 'START')
+    resumed.close()
+    assert ExecutionJournal.load(journal.path)['vm2'] == 'accepted'
+    assert ExecutionJournal.for_slot('r1:stop:20:no', 'retry', location=str(tmp_path)) is None
+
+
+def test_retry_failed_runs_only_the_failed_actions(fake, monkeypatch):
+    fake.db.insert_entries(discover(fake))
+    region = fake.CLIENTS.regions[0]
+    slot = fake.db.find_resources('vms', region, 'start', '08', 'no')
+    failing = {r['ocid'] for r in slot[:3]}
+    act = fake.CLIENTS.act
+
+    def flaky(ocid, transition, target):
+        if ocid in failing:
+            raise RuntimeError('InternalError')
+        act(ocid, transition, target)
+    monkeypatch.setattr(fake.CLIENTS, 'act', flaky)
+    report = fake.run_slot(region, 'start', '08', 'no')
+    assert report['failed'] == len(failing)
+
+    monkeypatch.setattr(fake.CLIENTS, 'act', act)
+    report = fake.run_slot(region, 'start', '08', 'no', mode='retry')
+    assert report['actions'] == len(failing) and report['failed'] == 0
+    assert fake.run_slot(region, 'start', '08', 'no', mode='resume') is None
+
+
+def test_sync_entries_applies_only_the_differences(fake):
+    entries = discover(fake)
+    fake.db.insert_entries(entries)
+    unchanged = fake.db.sync_entries(discover(fake))
+    assert not any(count for table in unchanged.values() for count in table.values())
+
+    vms = vm_entries(('vm1', '08', '20', 'No', 'RUNNING'), ('vm2', '08', '20', 'No', 'RUNNING'), ('vm3', '08', '20', 'Yes', 'RUNNING'))
+    fake.db.sync_entries(vms)
+    changes = fake.db.sync_entries(vm_entries(
+        ('vm1', '08', '20', 'No', 'RUNNING'), ('vm2', '09', '20', 'No', 'RUNNING'), ('vm3', '08', '20', 'Yes', 'STOPPED'), ('vm4', '08', '20', 'No', 'RUNNING')))
+    assert changes['vms'] == {'added': 1, 'removed': 0, 'retagged': 1, 'updated': 1}
+    assert changes['db'] == {'added': 0, 'removed': 0, 'retagged': 0, 'updated': 0}
+    assert [r['ocid'] for r in fake.db.find_resources('vms', 'r1', 'start', '09', 'no')] == ['vm2']
+    assert fake.db.find_resources('vms', 'r1', 'start', '08', 'yes')[0]['lifecycle_state'] == 'STOPPED'
+
+
+def test_slot_leaves_the_store_in_step_with_the_tenancy(fake):
+    fake.db.sync_entries(discover(fake))
+    region = fake.CLIENTS.regions[0]
+    report = fake.run_slot(region, 'start', '08', 'no')
+    assert report['issued'] > 0 and report['failed'] == 0
+    unchanged = fake.db.sync_entries(discover(fake))
+    assert not any(count for table in unchanged.values() for count in table.values())
+
+    #slots queued on a shared engine store their states once it has run
+    engine = ocicron_service.ActionEngine()
+    fake.run_slot(region, 'stop', '20', 'no', engine=engine)
+    engine.run('dispatch:20')
+    unchanged = fake.db.sync_entries(discover(fake))
+    assert not any(count for table in unchanged.values() for count in table.values())
+
+
+@pytest.mark.parametrize('action, hour, state, first, last', [
+    ('start', '08', 'STOPPED', 'dbnode', 'instance'),
+    ('stop', '20', 'RUNNING', 'instance', 'dbnode'),
+])
+def test_slot_issues_actions_in_priority_order(fake, monkeypatch, action, hour, state, first, last):
+    monkeypatch.setattr(fake, 'CLIENTS', FakeTenancy(compartments=3, instances=10, db_systems=1, tagged=1.0, slots=1, initial_state=state))
+    fake.db.insert_entries(discover(fake))
+    issued = []
+    act = fake.CLIENTS.act
+
+    def recorded(ocid, transition, target):
+        issued.append(ocid.split('.')[1])
+        act(ocid, transition, target)
+    monkeypatch.setattr(fake.CLIENTS, 'act', recorded)
+    engine = ocicron_service.ActionEngine(workers=1)
+    fake.run_slot(fake.CLIENTS.regions[0], action, hour, 'no', engine=engine)
+    engine.run()
+    assert issued.count(first) > 0 and issued.count(last) > 0
+    assert issued == [first] * issued.count(first) + [last] * issued.count(last)
+
+
+def test_slot_reports_the_rate_limit_wait_of_its_workers(fake, monkeypatch):
+    monkeypatch.setitem(ocicron_service.RATE_LIMITS, 'compute', (50, 1))
+    fake.db.insert_entries(discover(fake))
+    report = fake.run_slot(fake.CLIENTS.regions[0], 'start', '08', 'no')
+    assert report['rate_limit_wait'] > 0
+    assert 0 < report['blocked_share'] <= 1
+
+
+@pytest.mark.parametrize('compartment_node_listing', [True, False])
+def test_every_node_of_the_tagged_db_systems_is_scheduled(fake, monkeypatch, compartment_node_listing):
+    tenancy = FakeTenancy(compartments=3, instances=2, db_systems=2, db_nodes=2, tagged=1.0, slots=1,
+        compartment_node_listing=compartment_node_listing)
+    monkeypatch.setattr(fake, 'CLIENTS', tenancy)
+    region = tenancy.regions[0]
+    entries = discover(fake)
+
+    #every DB system shares the tags of the only slot, so one group holds their nodes
+    assert len(entries['db_nodes']) == 1
+    group = entries['db_nodes'][0]
+    expected = {tenancy.ocid('dbnode', region, c, n): tenancy.ocid('dbsystem', region, c, n // 2) for c in range(3) for n in range(4)}
+    assert sorted(group['dbnodeOCID']) == sorted(expected)
+    assert {ocid: details[2] for ocid, details in group['details'].items()} == expected
+    #one listing per compartment, or per DB system after the first compartments were refused
+    if compartment_node_listing:
+        assert tenancy.calls['ListDbNodes'] == 3
+    else:
+        assert 3 * 2 < tenancy.calls['ListDbNodes'] <= 3 + 3 * 2
+
+
+def slot_entries(prefix, count, start, stop='20', weekend='No', deadline=None):
+    """
+    Entries of count VMs of compartment c1 sharing a slot, named prefix00, prefix01...
+    """
+    ocids = ['{}{:02d}'.format(prefix, i) for i in range(count)]
+    return {'region': 'r1', 'Start': start, 'Stop': stop, 'Weekend_stop': weekend, 'vmOCID': ocids,
+        'details': {ocid: ('c1', 'STOPPED', None, 20, deadline) for ocid in ocids}}
+
+
+@pytest.fixture
+def planner(controller, monkeypatch):
+    """
+    ocicron with a compute budget of 6 calls per minute: the first action of a compartment in a
+    minute costs its state listing and the action, 5 actions of one compartment fit a minute
+    """
+    monkeypatch.setitem(ocicron_service.RATE_LIMITS, 'compute', (0.1, 1))
+    monkeypatch.setattr(controller, 'SMOOTHING_RATE_FRACTION', 1.0)
+    return controller
+
+
+def test_planner_splits_a_crowded_slot_in_waves(planner):
+    planner.db.insert_entries({'vms': [slot_entries('vm', 12, '08')]})
+    plan = planner.plan_load(window=10)
+    assert plan.waves[('r1', 'start', '08', 'no')] == {0: 5, 1: 5, 2: 2}
+    assert plan.over_budget() == []
+
+    #the offsets are stored, the first wave is left at the slot time, and select the resources of each wave
+    stored = {r['ocid']: r['start_offset'] or 0 for r in planner.db.slot_resources()}
+    assert stored == {'vm{:02d}'.format(i): i // 5 for i in range(12)}
+    assert [r['ocid'] for r in planner.db.find_resources('vms', 'r1', 'start', '08', 'no', offset=1)] == ['vm05', 'vm06', 'vm07', 'vm08', 'vm09']
+    assert len(planner.db.find_resources('vms', 'r1', 'start', '08', 'no')) == 12
+    #a new plan of the stored schedule changes nothing
+    assert planner.LoadPlanner(10, 1.0).plan(planner.db.slot_resources()).changes() == {}
+
+    planner.sync_commands()
+    jobs = planner.cron.jobs('--action start')
+    assert {command.rpartition('--offset ')[2]: schedule for command, schedule in jobs.items()} == {
+        '0': '0 8 * * *', '1': '1 8 * * *', '2': '2 8 * * *'}
+
+    wheel = ocicron_service.SlotWheel(planner.db.slot_waves())
+    assert wheel.due(datetime.datetime(2026, 10, 12, 8, 1)) == [('r1', 'start', '08', 'no', 1)]
+    assert wheel.due(datetime.datetime(2026, 10, 12, 8, 3)) == []
+
+
+def test_planner_shifts_a_slot_whose_minute_is_taken(planner):
+    planner.db.insert_entries({'vms': [slot_entries('a', 5, '08'), slot_entries('b', 3, '08', stop='21', weekend='Yes')]})
+    plan = planner.plan_load(window=10)
+    #the first slot fills 08:00, the second one fits whole in the next minute
+    assert plan.waves[('r1', 'start', '08', 'no')] == {0: 5}
+    assert plan.waves[('r1', 'start', '08', 'yes')] == {1: 3}
+    assert plan.changes() == {'vms': [(1, 0, 'b{:02d}'.format(i)) for i in range(3)]}
+
+    wheel = ocicron_service.SlotWheel(planner.db.slot_waves())
+    assert wheel.due(datetime.datetime(2026, 10, 12, 8, 0)) == [('r1', 'start', '08', 'no', None)]
+    assert wheel.due(datetime.datetime(2026, 10, 12, 8, 1)) == [('r1', 'start', '08', 'yes', 1)]
+    #weekend stop slots don't fire on Saturday
+    assert wheel.due(datetime.datetime(2026, 10, 17, 8, 1)) == []
+
+    #without a window every slot fires at its tagged time again
+    assert planner.plan_load(window=0).changes() == {'vms': [(0, 0, 'b{:02d}'.format(i)) for i in range(3)]}
+
+
+@pytest.mark.parametrize('start, deadline', [('08', 1), ('23:59', None)])
+def test_planner_keeps_waves_within_the_deadline_and_the_day(planner, start, deadline):
+    planner.db.insert_entries({'vms': [slot_entries('vm', 12, start, deadline=deadline)]})
+    plan = planner.plan_load(window=10)
+    assert plan.waves[('r1', 'start', start, 'no')] == {0: 12}
+    assert {offsets['start'] for offsets in plan.offsets.values()} == {0}
+    minute = ocicron_service.slot_minute(start)
+    assert [late for late in plan.over_budget() if late[2] == minute] == [('r1', 'compute', minute, 13)]
+
+
+def test_slot_wave_acts_only_on_its_resources(fake, monkeypatch):
+    fake.db.insert_entries(discover(fake))
+    region = fake.CLIENTS.regions[0]
+    monkeypatch.setitem(ocicron_service.RATE_LIMITS, 'compute', (0.1, 1))
+    monkeypatch.setattr(fake, 'SMOOTHING_RATE_FRACTION', 1.0)
+    plan = fake.plan_load(window=10)
+    assert len(plan.waves[(region, 'start', '08', 'no')]) > 1
+    monkeypatch.setitem(ocicron_service.RATE_LIMITS, 'compute', (1000, 1000))
+
+    wave = {r['ocid'] for r in fake.db.find_resources('vms', region, 'start', '08', 'no', offset=1)}
+    report = fake.run_slot(region, 'start', '08', 'no', offset=1)
+    assert report['issued'] == len(wave)
+    assert {ocid for ocid in fake.CLIENTS.changes if '.instance.' in ocid} == wave
+
+
+def test_defaults_follow_the_settings_at_call_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(ocicron_service, 'ACTION_WORKERS', 3)
+    monkeypatch.setattr(ocicron_service, 'JOURNAL_SYNC_EVERY', 7)
+    monkeypatch.setattr(ocicron_service, 'TOKEN_CACHE_FILE', None)
+    monkeypatch.setattr(ocicron_service, 'TOKEN_REFRESH_MARGIN', 60)
+    monkeypatch.setattr(ocicron_service, 'DISCOVERY_WORKERS', 5)
+    assert ocicron_service.ActionEngine().workers == 3
+    journal = ExecutionJournal(str(tmp_path / 'slot.journal'))
+    journal.close()
+    assert journal.sync_every == 7
+    cache = TokenCache()
+    assert cache.location is None and cache.margin == 60
+    assert OCI('config', clients=FakeTenancy(compartments=1, instances=1)).workers == 5